@@ -1,5 +1,10 @@
 from easy import capture_solution, versus_summaries  # one-step solutions
-from ui import GUI  # easy to use GUI
+
+
+def GUI():
+    """Start the easy to use GUI. The GUI parts are only imported here."""
+    from ui import GUI
+    return GUI()
 
 
 if __name__ == '__main__':
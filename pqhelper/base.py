@@ -4,12 +4,229 @@ import random
 import numpy
 
 import pqhelper.data as pq_data
-from investigators import visuals as v
 from stemnode import TreeNode
 
 
 Summary = namedtuple('Summary', ('board', 'action', 'score',
-                                 'mana_drain_leaves', 'total_leaves'))
+                                 'mana_drain_leaves', 'total_leaves',
+                                 'score_variance', 'score_interval'))
+# the spread of the score is optional (e.g. capture or single sims)
+Summary.__new__.__defaults__ = (None, None)
+
+
+class BatchIdentifier(object):
+    """Identify many images at once by comparing all of them with all
+    templates in one matrix operation.
+
+    Images and templates are all shrunk to one common size so each
+    comparison is a single normalized square difference (same scale as
+    ImageIdentifier: 0 is identical).
+
+    Most images are identified by a tiny color signature first. Only those
+    that are ambiguous by color are shrunk and compared at the full size.
+    """
+    # the best signature must be clearly better than the second best
+    SIGNATURE_MARGIN = 4.0
+
+    def __init__(self, templates, size=(32, 32), acceptable_threshold=0.5,
+                 ambiguous=(), signature_size=(4, 4)):
+        """Arguments:
+        - templates: dict of name: opencv bgr image
+        - size: (height, width) that everything is compared at
+        - acceptable_threshold: highest match value identified as a template
+        - ambiguous: names of templates that look too much like others by
+            color so they are always compared at the full size
+        - signature_size: (height, width) of the color signatures. None to
+            compare everything at the full size
+        """
+        self._size = size
+        self._names = sorted(templates)
+        ordered = [templates[name] for name in self._names]
+        self._templates = self._stacked(ordered, size)
+        self._template_squares = numpy.square(self._templates).sum(axis=1)
+        self._signature_size = signature_size
+        if signature_size is not None:
+            self._signatures = self._stacked(ordered, signature_size)
+            self._signature_squares = \
+                numpy.square(self._signatures).sum(axis=1)
+            self._ambiguous = numpy.array([name in ambiguous
+                                           for name in self._names])
+        self.acceptable_threshold = acceptable_threshold
+
+    def identify_many(self, images):
+        """Return the best matching template name for each image (None if
+        no template is acceptable) and the match value of each image.
+        Lower match values are more confident. Images identified by their
+        signature have the match value of their signature.
+        """
+        names = [None] * len(images)
+        match_values = numpy.empty(len(images))
+        remaining = range(len(images))
+        if self._signature_size is not None:
+            differences = self._differences(
+                self._stacked(images, self._signature_size),
+                self._signatures, self._signature_squares,
+                self._signature_size)
+            rows = numpy.arange(len(images))
+            best = differences.argmin(axis=1)
+            best_values = differences[rows, best]
+            differences[rows, best] = numpy.inf
+            second_values = differences.min(axis=1)
+            identified = (~self._ambiguous[best]
+                          & (best_values <= self.acceptable_threshold)
+                          & (second_values
+                             >= self.SIGNATURE_MARGIN * best_values))
+            for i in numpy.flatnonzero(identified):
+                names[i] = self._names[best[i]]
+                match_values[i] = best_values[i]
+            remaining = numpy.flatnonzero(~identified)
+        if len(remaining):
+            differences = self._differences(
+                self._stacked([images[i] for i in remaining], self._size),
+                self._templates, self._template_squares, self._size)
+            best = differences.argmin(axis=1)
+            best_values = differences[numpy.arange(len(remaining)), best]
+            for i, template_i, value in zip(remaining, best, best_values):
+                if value <= self.acceptable_threshold:
+                    names[i] = self._names[template_i]
+                match_values[i] = value
+        return names, match_values
+
+    def _differences(self, stacked, templates, template_squares, size):
+        """Return the normalized square differences of every stacked image
+        (rows) with every stacked template (columns)."""
+        # by expanding (a - b)^2 into a^2 + b^2 - 2ab
+        differences = (numpy.square(stacked).sum(axis=1)[:, numpy.newaxis]
+                       + template_squares
+                       - 2 * numpy.dot(stacked, templates.T))
+        h, w = size
+        differences /= (255 ** 2) * h * w
+        return differences
+
+    def _stacked(self, images, size):
+        """Return the images resized to size as rows of floats."""
+        from investigators.visuals import cv2
+        h, w = size
+        resized = [cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)
+                   for image in images]
+        return numpy.array(resized, dtype=float).reshape(len(images), -1)
+
+
+class TankReader(object):
+    """Read the fill levels of many tanks in an image in one pass.
+
+    Each tank pixel is classified as the closest of its tank's fill, empty
+    and ignore colors. Lines across a tank that are mostly ignore are
+    outside the tank. The level is the proportion of the other lines that
+    have enough fill.
+    """
+    # text and shading over a tank can cover most of a filled line
+    FILLED_LINE_PROPORTION = 0.15
+
+    def __init__(self, tanks):
+        """Arguments:
+        - tanks: sequence of (proportions, colors, sideways) for each tank
+            - proportions: (top, left, bottom, right) proportions of the image
+            - colors: (fill, empty, ignore) bgr colors
+            - sideways: True if the tank fills from the left instead of
+                from the bottom
+        """
+        from investigators import visuals as v
+        self._regions = [v.ProportionalRegion(proportions)
+                         for proportions, colors, sideways in tanks]
+        self._colors = numpy.array([colors for p, colors, s in tanks],
+                                   dtype=int)
+        self._sideways = [sideways for p, c, sideways in tanks]
+        self._indexes = dict()  # pixel and line indexes by image size
+
+    def levels(self, image):
+        """Return the proportion from 0 to 1 that each tank is filled or
+        None for tanks that are not found.
+        """
+        rows, columns, pixel_tanks, pixel_lines, line_tanks = \
+            self._pixel_indexes(image.shape[0:2])
+        pixels = image[rows, columns].astype(int)
+        # closest of fill (0), empty (1) and ignore (2) for every pixel
+        distances = numpy.square(pixels[:, numpy.newaxis, :]
+                                 - self._colors[pixel_tanks]).sum(axis=-1)
+        closest = distances.argmin(axis=1)
+        # count each color on every line of every tank
+        line_count = len(line_tanks)
+        counts = numpy.bincount(pixel_lines * 3 + closest,
+                                minlength=line_count * 3)
+        fill, empty, ignore = counts.reshape(line_count, 3).T
+        in_tank = fill + empty > ignore
+        filled = in_tank & (fill >= self.FILLED_LINE_PROPORTION
+                            * (fill + empty))
+        tank_count = len(self._regions)
+        tank_lines = numpy.bincount(line_tanks, weights=in_tank,
+                                    minlength=tank_count)
+        filled_lines = numpy.bincount(line_tanks, weights=filled,
+                                      minlength=tank_count)
+        return [float(filled) / lines if lines else None
+                for filled, lines in zip(filled_lines, tank_lines)]
+
+    def _pixel_indexes(self, size):
+        """Return the row, column, tank and line of every tank pixel and
+        the tank of every line for images of the given size.
+        """
+        if size not in self._indexes:
+            image = numpy.empty(size)  # only the shape is used
+            parts = list()
+            line_count = 0
+            for tank, region in enumerate(self._regions):
+                t, l, b, r = region.region_in(image)
+                rows, columns = numpy.mgrid[t:b, l:r]
+                lines = columns - l if self._sideways[tank] else rows - t
+                parts.append((rows.ravel(), columns.ravel(),
+                              numpy.repeat(tank, rows.size),
+                              lines.ravel() + line_count,
+                              numpy.repeat(tank, lines.max() + 1)))
+                line_count += lines.max() + 1
+            self._indexes[size] = tuple(numpy.concatenate(part)
+                                        for part in zip(*parts))
+        return self._indexes[size]
+
+
+class _shared_tools(object):
+    """Make a class attribute that is built by the decorated function the
+    first time it is used and then shared by all instances.
+    """
+    def __init__(self, build):
+        self._build = build
+
+    def __get__(self, instance, owner):
+        tools = self._build(owner)
+        setattr(owner, self._build.__name__, tools)  # replaces the builder
+        return tools
+
+
+def _scaled_size(size, scale):
+    """Return (rows, columns) size scaled the same way as TemplateFinder."""
+    h, w = size
+    return int(round(h * scale)), int(round(w * scale))
+
+
+def _prescaled_finder(template, sizes, scale_for_speed=1, **thresholds):
+    """Return a TemplateFinder that takes its template for each size from
+    template(final size), e.g. pre-scaled in the template pack, instead of
+    resizing the full template for every size.
+
+    Arguments:
+    - template: function that returns the template at an optional
+        (rows, columns) size. see pqhelper.data
+    - sizes, scale_for_speed, thresholds: same as TemplateFinder
+    """
+    from investigators import visuals as v
+
+    class PrescaledFinder(v.TemplateFinder):
+        def _build_templates(self):
+            return dict((size, template(_scaled_size(size,
+                                                     self.scale_for_speed)))
+                        for size in self.sizes)
+
+    return PrescaledFinder(template(), sizes=sizes,
+                           scale_for_speed=scale_for_speed, **thresholds)
 
 
 class StateInvestigator(object):
@@ -19,14 +236,15 @@ class StateInvestigator(object):
     stored data that would clutter up the module namespace.
     """
     # these are the possible shapes of the main game screen in PQ
-    _GAME_SIZES = (v.Dimensions(480, 640),
-                   v.Dimensions(600, 800),
-                   v.Dimensions(768, 1024),
-                   v.Dimensions(800, 1066),
-                   v.Dimensions(960, 1280),
-                   v.Dimensions(1024, 1280),
-                   v.Dimensions(1050, 1400),
-                   v.Dimensions(1200, 1600))
+    # (rows, columns)
+    _GAME_SIZES = ((480, 640),
+                   (600, 800),
+                   (768, 1024),
+                   (800, 1066),
+                   (960, 1280),
+                   (1024, 1280),
+                   (1050, 1400),
+                   (1200, 1600))
 
     # proportions of various parts determined by mesauring pixels on images
     # all proportions are in top, left, bottom, right order
@@ -62,52 +280,117 @@ class StateInvestigator(object):
                     'y': ((0, 135, 135), (20, 40, 40), (25, 25, 25)),
                     'b': ((135, 0, 0), (45, 30, 30), (25, 25, 25))}
 
-    _game_finders = {'capture': v.TemplateFinder(pq_data.capture_template,
-                                                 sizes=_GAME_SIZES,
-                                                 scale_for_speed=0.5,
-                                                 immediate_threshold=0.1,
-                                                 acceptable_threshold=0.4),
-                     'versus': v.TemplateFinder(pq_data.versus_template,
-                                                sizes=_GAME_SIZES,
-                                                scale_for_speed=0.5,
-                                                immediate_threshold=0.1,
-                                                acceptable_threshold=0.4)}
-
-    _board_tools = {'board_region': v.ProportionalRegion(_BOUNDS['board']),
-                    'grid': v.Grid((8, 8), (0, 0, 0, 0)),
-                    'tile_id': v.ImageIdentifier(pq_data.tile_templates,
-                                                 acceptable_threshold=0.2,
-                                                 immediate_threshold=0.05)}
-
-    _bonus_tools = {'extra_action_region': v.ProportionalRegion(
-        _BOUNDS['extra_actions'])}
-
-    _player_tools = {'health_region': v.ProportionalRegion(_BOUNDS['p_health']),
-                     'g_region': v.ProportionalRegion(_BOUNDS['p_g']),
-                     'r_region': v.ProportionalRegion(_BOUNDS['p_r']),
-                     'y_region': v.ProportionalRegion(_BOUNDS['p_y']),
-                     'b_region': v.ProportionalRegion(_BOUNDS['p_b']),
-                     'health_tank': v.TankLevel(*_TANK_COLORS['health']),
-                     'g_tank': v.TankLevel(*_TANK_COLORS['g']),
-                     'r_tank': v.TankLevel(*_TANK_COLORS['r']),
-                     'y_tank': v.TankLevel(*_TANK_COLORS['y']),
-                     'b_tank': v.TankLevel(*_TANK_COLORS['b'])}
-
-    _oppnt_tools = {'health_region': v.ProportionalRegion(_BOUNDS['o_health']),
-                    'g_region': v.ProportionalRegion(_BOUNDS['o_g']),
-                    'r_region': v.ProportionalRegion(_BOUNDS['o_r']),
-                    'y_region': v.ProportionalRegion(_BOUNDS['o_y']),
-                    'b_region': v.ProportionalRegion(_BOUNDS['o_b']),
-                    'health_tank': v.TankLevel(*_TANK_COLORS['health']),
-                    'g_tank': v.TankLevel(*_TANK_COLORS['g']),
-                    'r_tank': v.TankLevel(*_TANK_COLORS['r']),
-                    'y_tank': v.TankLevel(*_TANK_COLORS['y']),
-                    'b_tank': v.TankLevel(*_TANK_COLORS['b'])}
-
-    def get_capture(self):
-        """Return the capture board or None if can't find it."""
+    # game templates are matched at this scale to speed up the search
+    _GAME_SCALE_FOR_SPEED = 0.5
+    # pixels around a remembered game location to allow for small shifts
+    _GAME_LOCATION_MARGIN = 8
+    # finders for a single size, built once when each size is first seen
+    _sized_finders = dict()
+    # mean pixel difference from the last board image for a tile to be
+    # identified again. the most similar tiles (wildcards) differ by ~10
+    _TILE_CHANGE_THRESHOLD = 4.0
+
+    # stats read from tanks for each actor and the maximum of each. the
+    # other stats have fixed values below. x, m, h or c can be read too by
+    # adding them here along with their p_ / o_ bounds and tank colors
+    _TANK_STATS = (('health', 100), ('r', 40), ('g', 40), ('b', 40), ('y', 40))
+    _FIXED_STATS = {'x': (0, 1000), 'm': (0, 1000),  # simply start at zero
+                    'h': (0, 0), 'c': (0, 0)}  # unused
+    _ACTOR_BOUNDS_PREFIXES = (('player', 'p_'), ('opponent', 'o_'))
+
+    # the tools below load images so they are only built when first used
+
+    @_shared_tools
+    def _game_finders(cls):
+        scale = cls._GAME_SCALE_FOR_SPEED
+        return {'capture': _prescaled_finder(pq_data.capture_template,
+                                             sizes=cls._GAME_SIZES,
+                                             scale_for_speed=scale,
+                                             immediate_threshold=0.1,
+                                             acceptable_threshold=0.4),
+                'versus': _prescaled_finder(pq_data.versus_template,
+                                            sizes=cls._GAME_SIZES,
+                                            scale_for_speed=scale,
+                                            immediate_threshold=0.1,
+                                            acceptable_threshold=0.4)}
+
+    @_shared_tools
+    def _board_tools(cls):
+        from investigators import visuals as v
+        return {'board_region': v.ProportionalRegion(cls._BOUNDS['board']),
+                'grid': v.Grid((8, 8), (0, 0, 0, 0)),
+                # wildcards only differ by their digit and the anvil and
+                # scroll are close to other tiles by color
+                'tile_id': BatchIdentifier(pq_data.tile_templates(),
+                                           acceptable_threshold=0.2,
+                                           ambiguous='2345678hc')}
+
+    @_shared_tools
+    def _bonus_tools(cls):
+        from investigators import visuals as v
+        return {'extra_action_region': v.ProportionalRegion(
+            cls._BOUNDS['extra_actions'])}
+
+    @_shared_tools
+    def _actor_tools(cls):
+        # every tank of both actors in _ACTOR_BOUNDS_PREFIXES, _TANK_STATS
+        # order
+        return {'tanks': TankReader(
+            [(cls._BOUNDS[prefix + stat], cls._TANK_COLORS[stat],
+              stat == 'health')
+             for name, prefix in cls._ACTOR_BOUNDS_PREFIXES
+             for stat, maximum in cls._TANK_STATS])}
+
+    @_shared_tools
+    def _watched_regions(cls):
+        # regions of each game type that are watched for changes and the
+        # (height, width) of the thumbnail kept for each
+        from investigators import visuals as v
+        board = v.ProportionalRegion(cls._BOUNDS['board']), (32, 32)
+        extra_actions = (v.ProportionalRegion(cls._BOUNDS['extra_actions']),
+                         (4, 12))
+        tanks = [(v.ProportionalRegion(cls._BOUNDS[prefix + stat]), (8, 8))
+                 for name, prefix in cls._ACTOR_BOUNDS_PREFIXES
+                 for stat, maximum in cls._TANK_STATS]
+        return {'capture': (board,),
+                'versus': tuple([board, extra_actions] + tanks)}
+
+    @classmethod
+    def build_template_pack(cls, pack_path=None):
+        """Pack every template with its variants for all _GAME_SIZES into
+        one file that each process memory maps. see data.build_pack.
+
+            python setup.py build_templates
+        """
+        game_sizes = [_scaled_size(size, cls._GAME_SCALE_FOR_SPEED)
+                      for size in cls._GAME_SIZES]
+        token_sizes = [cls._token_size(size) for size in cls._GAME_SIZES]
+        pq_data.build_pack({'capture': game_sizes,
+                            'versus': game_sizes,
+                            'extra_action': token_sizes},
+                           pack_path or pq_data.PACK_PATH)
+
+    def __init__(self):
+        # last location and size of each type of game
+        self._game_locations = dict()
+        # last board image and its tile characters and match values to
+        # skip unchanged tiles
+        self._last_board = None, None, None
+        # match value of each tile position of the last board read. lower
+        # is more confident on the same scale as the acceptable threshold
+        self.tile_match_values = None
+
+    def get_capture(self, screen_image=None):
+        """Return the capture board or None if can't find it. The
+        confidence of each tile is in tile_match_values.
+
+        Arguments:
+        - screen_image: optional opencv image to investigate instead of
+            the screen. e.g. a saved screenshot
+        """
+        self.tile_match_values = None
         # game
-        game_image = self._game_image_from_screen('capture')
+        game_image = self._game_image_from_screen('capture', screen_image)
         if game_image is None:
             return
         # board
@@ -118,12 +401,17 @@ class StateInvestigator(object):
             return
         return board
 
-    def get_versus(self):
+    def get_versus(self, screen_image=None):
         """Return the versus board, player, opponent and extra actions.
-        Return None for any parts that can't be found.
+        Return None for any parts that can't be found. The confidence of
+        each tile is in tile_match_values.
+
+        Arguments:
+        - screen_image: same as get_capture
         """
+        self.tile_match_values = None
         # game
-        game_image = self._game_image_from_screen('versus')
+        game_image = self._game_image_from_screen('versus', screen_image)
         if game_image is None:
             return None, None, None, None  # nothing else will work
         # board
@@ -134,29 +422,115 @@ class StateInvestigator(object):
                 if tile.is_blank():
                     board = None
         # actors
-        player = self._actor_from_game_image('player', game_image)
-        opponent = self._actor_from_game_image('opponent', game_image)
+        player, opponent = self._actors_from_game_image(game_image)
         # extra actions
         extra_actions = self._count_extra_actions(game_image)
         return board, player, opponent, extra_actions
 
+    def game_signature(self, game_type):
+        """Return small thumbnails of the watched parts of the game on
+        screen as one flat array or None if no game is found. This is much
+        cheaper than reading the game and is enough to tell when the game
+        visibly changes. See ChangeWatcher.
+
+        Arguments:
+        - game_type: 'capture' or 'versus'
+        """
+        game_image = self._game_image_from_screen(game_type)
+        if game_image is None:
+            return None
+        from investigators.visuals import cv2
+        thumbnails = list()
+        for region, (h, w) in self._watched_regions[game_type]:
+            t, l, b, r = region.region_in(game_image)
+            thumbnail = cv2.resize(game_image[t:b, l:r], (w, h),
+                                   interpolation=cv2.INTER_AREA)
+            thumbnails.append(thumbnail.ravel())
+        return numpy.concatenate(thumbnails)
+
     def _screen_shot(self):
+        from investigators import visuals as v
         return v.screen_shot()
 
-    def _game_image_from_screen(self, game_type):
-        """Return the image of the given game type from the screen.
-        Return None if no game is found.
+    def _game_image_from_screen(self, game_type, screen_img=None):
+        """Return the image of the given game type from the screen (or
+        screen_img if provided). Return None if no game is found.
         """
         # screen
-        screen_img = self._screen_shot()
-        # game image
-        game_rect = self._game_finders[game_type].locate_in(screen_img)
+        if screen_img is None:
+            screen_img = self._screen_shot()
+        # game image. the window rarely moves so check the last location first
+        game_rect = self._revalidated_game_rect(game_type, screen_img)
         if game_rect is None:
-            return
+            finder = self._game_finders[game_type]
+            game_rect = finder.locate_in(screen_img)
+            if game_rect is None:
+                self._game_locations.pop(game_type, None)
+                return
+            self._game_locations[game_type] = \
+                game_rect, self._closest_game_size(game_rect)
         t, l, b, r = game_rect
         game_img = screen_img[t:b, l:r]
         return game_img
 
+    def _revalidated_game_rect(self, game_type, screen_img):
+        """Return the game rectangle if the game is still at (or within a
+        small margin of) its last location. Otherwise return None.
+        """
+        try:
+            last_rect, size = self._game_locations[game_type]
+        except KeyError:
+            return None
+        finder = self._sized_finder(game_type, size)
+        margin = self._GAME_LOCATION_MARGIN
+        screen_h, screen_w = screen_img.shape[0:2]
+        t, l, b, r = last_rect
+        t, l = max(0, t - margin), max(0, l - margin)
+        b, r = min(screen_h, b + margin), min(screen_w, r + margin)
+        found = finder.locate_in(screen_img[t:b, l:r])
+        if found is None:
+            return None
+        from investigators import visuals as v
+        found_t, found_l, found_b, found_r = found
+        return v.Rectangle(t + found_t, l + found_l, t + found_b, l + found_r)
+
+    def _closest_game_size(self, game_rect):
+        """Return the game size closest to the size of game_rect."""
+        t, l, b, r = game_rect
+        h, w = b - t, r - l
+        return min(self._GAME_SIZES,
+                   key=lambda (rows, cols): abs(rows - h) + abs(cols - w))
+
+    def _sized_finder(self, kind, size):
+        """Return a finder with its template resized once for size.
+
+        Arguments:
+        kind: 'capture' or 'versus' for the game (size is the game size) or
+            'extra_action' for the extra action token (size is the token size)
+        """
+        from investigators import visuals as v
+        key = kind, size
+        if key not in self._sized_finders:
+            # the finders are given templates that are already at their
+            # final size so they don't resize them again
+            if kind == 'extra_action':
+                # thresholds are tight since need to count conservatively
+                finder = v.TemplateFinder(pq_data.extra_action_template(size),
+                                          sizes=(size,),
+                                          acceptable_threshold=0.1,
+                                          immediate_threshold=0.1)
+            else:
+                game_finder = self._game_finders[kind]
+                scale = game_finder.scale_for_speed
+                template = getattr(pq_data, kind + '_template')
+                finder = v.TemplateFinder(
+                    template(_scaled_size(size, scale)), sizes=(size,),
+                    scale_for_speed=scale,
+                    immediate_threshold=game_finder.immediate_threshold,
+                    acceptable_threshold=game_finder.acceptable_threshold)
+            self._sized_finders[key] = finder
+        return self._sized_finders[key]
+
     def _board_from_game_image(self, game_image):
         """Return a board object matching the board in the game image.
         Return None if any tiles are not identified.
@@ -165,65 +539,73 @@ class StateInvestigator(object):
         board_rect = self._board_tools['board_region'].region_in(game_image)
         t, l, b, r = board_rect
         board_image = game_image[t:b, l:r]
-        # board grid and tiles --> fill in a Board object
-        board = Board()
+        # board grid and tiles --> identify all changed tiles at once
         grid = self._board_tools['grid']
-        tile_id = self._board_tools['tile_id']
-        for p, borders in grid.borders_by_grid_position(board_image):
-            t, l, b, r = borders
-            tile = board_image[t:b, l:r]
-            tile_character = tile_id.identify(tile)
-            if tile_character is None:
-                return None  # soft failure
+        positions, tile_borders = zip(*grid.borders_by_grid_position(
+            board_image))
+        tile_characters, match_values = \
+            self._changed_tiles_identified(board_image, tile_borders)
+        self.tile_match_values = dict(zip(positions, match_values))
+        if None in tile_characters:
+            self._last_board = None, None, None
+            return None  # soft failure
+        self._last_board = board_image.copy(), tile_characters, match_values
+        # fill in a Board object
+        board = Board()
+        for p, tile_character in zip(positions, tile_characters):
             board[p] = Tile.singleton(tile_character)
         return board
 
-    def _actor_from_game_image(self, name, game_image):
-        """Return an actor object matching the one in the game image.
+    def _changed_tiles_identified(self, board_image, tile_borders):
+        """Return the tile character and match value in each of
+        tile_borders. Tiles that look the same as in the last board image
+        keep their last character and match value.
+        """
+        last_image, last_characters, last_match_values = self._last_board
+        if last_image is None or last_image.shape != board_image.shape:
+            tile_characters = [None] * len(tile_borders)
+            tile_match_values = [None] * len(tile_borders)
+            changed = range(len(tile_borders))
+        else:
+            tile_characters = list(last_characters)
+            tile_match_values = list(last_match_values)
+            differences = numpy.abs(board_image.astype(int) - last_image)
+            changed = [i for i, (t, l, b, r) in enumerate(tile_borders)
+                       if differences[t:b, l:r].mean()
+                       > self._TILE_CHANGE_THRESHOLD]
+        if changed:
+            tiles = [board_image[t:b, l:r]
+                     for t, l, b, r in (tile_borders[i] for i in changed)]
+            found, match_values = \
+                self._board_tools['tile_id'].identify_many(tiles)
+            for i, tile_character, match_value in zip(changed, found,
+                                                      match_values):
+                tile_characters[i] = tile_character
+                tile_match_values[i] = float(match_value)
+        return tile_characters, tile_match_values
+
+    def _actors_from_game_image(self, game_image):
+        """Return the player and opponent matching those in the game image.
+        Return None for an actor if any of its tanks can not be read.
 
         Note:
         Health and mana are based on measured percentage of a fixed maximum
         rather than the actual maximum in the game.
-
-        Arguments:
-        name: must be 'player' or 'opponent'
-        game_image: opencv image of the main game area
         """
-        HEALTH_MAX = 100
-        MANA_MAX = 40
-        # get the set of tools for investigating this actor
-        tools = {'player': self._player_tools,
-                 'opponent': self._oppnt_tools}[name]
-
-        # setup the arguments to be set:
-        args = [name]
-
-        # health:
-        t, l, b, r = tools['health_region'].region_in(game_image)
-        health_image = game_image[t:b, l:r]
-        health_image = numpy.rot90(health_image)  # upright for the TankLevel
-        how_full = tools['health_tank'].how_full(health_image)
-        if how_full is None:
-            return None  # failure
-        health = int(round(HEALTH_MAX * how_full))
-        args.append((health, HEALTH_MAX))
-        # mana
-        for color in ('r', 'g', 'b', 'y'):
-            t, l, b, r = tools[color + '_region'].region_in(game_image)
-            mana_image = game_image[t:b, l:r]
-            how_full = tools[color + '_tank'].how_full(mana_image)
-            if how_full is None:
-                return None  # failure
-            mana = int(round(MANA_MAX * how_full))
-            args.append((mana, MANA_MAX))
-        # experience and coins simply start at zero
-        x_m = (0, 1000), (0, 1000)
-        args.extend(x_m)
-        # hammer and scroll are unused
-        h_c = (0, 0), (0, 0)
-        args.extend(h_c)
-        # build the actor and return it
-        return Actor(*args)
+        levels = iter(self._actor_tools['tanks'].levels(game_image))
+        actors = list()
+        for name, prefix in self._ACTOR_BOUNDS_PREFIXES:
+            stats = dict(self._FIXED_STATS)
+            for stat, maximum in self._TANK_STATS:
+                how_full = levels.next()
+                stats[stat] = None if how_full is None \
+                    else (int(round(maximum * how_full)), maximum)
+            if None in stats.values():
+                actors.append(None)  # failure
+            else:
+                actors.append(Actor(name, *(stats[stat]
+                                            for stat in _ACTOR_STATS)))
+        return actors
 
     def _count_extra_actions(self, game_image):
         """Count the number of extra actions for player in this turn."""
@@ -232,19 +614,18 @@ class StateInvestigator(object):
         t, l, b, r = proportional.region_in(game_image)
         token_region = game_image[t:b, l:r]
         # Use TemplateFinder (multiple) to check for extra actions
-        game_h, game_w = game_image.shape[0:2]
-        token_h = int(round(game_h * 27.0 / 960))
-        token_w = int(round(game_w * 22.0 / 1280))
-        sizes = (token_h, token_w),
-        # sizes change every time so just remake it.
-        # thresholds are tight since need to count conservatively
-        finder = v.TemplateFinder(pq_data.extra_action_template,
-                                  sizes=sizes,
-                                  acceptable_threshold=0.1,
-                                  immediate_threshold=0.1)
+        token_size = self._token_size(game_image.shape[0:2])
+        finder = self._sized_finder('extra_action', token_size)
         found_tokens = finder.locate_multiple_in(token_region)
         return len(found_tokens)
 
+    @staticmethod
+    def _token_size(game_size):
+        """Return the (rows, columns) of an extra action token in a game."""
+        game_h, game_w = game_size
+        return (int(round(game_h * 27.0 / 960)),
+                int(round(game_w * 22.0 / 1280)))
+
     def generic_versus_actors(self):
         health = 50, 100
         v = 20, 40
@@ -256,19 +637,77 @@ class StateInvestigator(object):
         return player, opponent
 
 
+class ChangeWatcher(object):
+    """Tell when a game on screen has changed and settled again.
+
+    Feed it a signature of the game (see StateInvestigator.game_signature)
+    at regular intervals. Signatures are the same when at most tolerance
+    of their values differ by more than threshold. Averaging into
+    thumbnails already removes most pixel noise.
+    """
+    def __init__(self, threshold=16, tolerance=0):
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self._previous = None  # signature of the previous frame
+        self._settled = None  # signature of the last settled change
+
+    def settled_change(self, signature):
+        """Return True when signature is the same as the previous one
+        (nothing is moving) and different from the last settled one.
+        """
+        previous, self._previous = self._previous, signature
+        if signature is None or previous is None:
+            return False
+        if not self._same(signature, previous):
+            return False  # still changing. e.g. tiles falling
+        if self._settled is not None and self._same(signature, self._settled):
+            return False  # nothing new
+        self._settled = signature
+        return True
+
+    def _same(self, signature, other):
+        if len(signature) != len(other):
+            return False
+        differences = numpy.abs(signature.astype(int) - other)
+        changed = numpy.count_nonzero(differences > self.threshold)
+        return changed <= self.tolerance
+
+
 class Game(object):
     """Simulates the possibilities of a PQ game."""
+    # the sims of a state are stored as an int64 bit mask
+    MAX_SIMS = 63
+
     # Initialization and core attributes
-    def __init__(self, random_fill):
+    def __init__(self, random_fill, seed=None, sims=1, expected_refill=False):
         """Initialize a new game simulation container.
 
         Arguments:
         use_random_fill: True/False indicating to randomly fill boards or not.
+        seed: optional seed for the random fills of this simulation
+        sims: number of simulations run together in one tree. each sim has
+            its own random fills and sims share every state they agree on.
+            at most 63 since the sims of a state are an int64 bit mask.
+        expected_refill: for swaps from a root state, estimate the cascades
+            of the refill (see RandomFill.expected_cascade) instead of
+            sampling them. the estimate is stored on each Swap and the
+            refill is drawn without new matches. deeper fills are sampled.
         """
+        if not 0 < sims <= self.MAX_SIMS:
+            raise ValueError('Expected 1 to {} sims but got {}'
+                             ''.format(self.MAX_SIMS, sims))
         self.random_fill = random_fill
+        self.expected_refill = expected_refill
+        # when set, at most this many swaps are continued from each state
+        # after the first action of a turn
+        self.beam_width = None
+        self.ordering = SwapOrdering()
+        seeds = RandomFill(seed).spawn_seeds(sims)
+        self.fills = tuple(RandomFill(sim_seed) for sim_seed in seeds)
+        self._all_sims = (1 << sims) - 1
 
     # Run simulation
-    def ends_of_one_state(self, root=None, root_eot=None):
+    def ends_of_one_state(self, root=None, root_eot=None, keep_going=None):
         """Simulate a complete turn from one state only and generate each
         end of turn reached in the simulation.
 
@@ -276,7 +715,10 @@ class Game(object):
         Exactly one of:
             root: a start state with no parent
             or
-            root_eot: an EOT or ManaDrain transition in the simulation
+            root_eot: an EOT transition in the simulation
+        keep_going: optional callable checked before each state is
+            simulated. simulation stops as soon as it returns False and the
+            turn is left incomplete.
         """
         # basic confirmation of valid arguments
         self._argument_gauntlet(root_eot, root)
@@ -284,22 +726,40 @@ class Game(object):
         if root:
             start_state = root
         else:
-            start_state = State(root_eot.parent.board.copy(),
-                                root_eot.parent.player.copy(),
-                                root_eot.parent.opponent.copy(),
-                                root_eot.parent.turn + 1, 1)
+            last_state = root_eot.parent
+            start_state = State(last_state.board.copy(),
+                                last_state.player, last_state.opponent,
+                                last_state.turn + 1, 1,
+                                arena=last_state.arena, sims=last_state.sims)
             root_eot.graft_child(start_state)
         # track states that are stable - i.e. no remaining chain reactions
         ready_for_action = [start_state]
+        # states reached more than once in this turn are simulated only once
+        seen_states = dict()
         # simulate all actions for each state until reaching EOTs
         while ready_for_action:
+            if keep_going is not None and not keep_going():
+                return
             ready_state = ready_for_action.pop()
+            # handle states where the game is already over
+            if self._is_terminal(ready_state):
+                terminal_eot = EOT(False, is_terminal=True)
+                ready_state.graft_child(terminal_eot)
+                yield terminal_eot
+                continue  # no more simulation after the game ends
+            # handle states already reached through other actions
+            if ready_state is not start_state:
+                original = self._transposed_state(ready_state, seen_states)
+                if original is not None:
+                    ready_state.graft_child(Transposition(original))
+                    continue  # the original is simulated instead
             # handle states that have run out of actions (end of turn)
             if ready_state.actions_remaining <= 0:
-                root_eot = self._simulated_EOT(ready_state)
-                yield root_eot
+                for root_eot in self._simulated_EOT(ready_state):
+                    yield root_eot
                 continue  # no more simulation for an EOT
             # handle swaps when there are actions remaining
+            chain_results = list()
             for swap_result in self._simulated_swap_results(ready_state):
                 # handle any chain reactions
                 if swap_result.actions_remaining \
@@ -307,22 +767,24 @@ class Game(object):
                     already_used_bonus = True
                 else:
                     already_used_bonus = False
-                chain_result = self._simulated_chain_result(swap_result,
-                                                            already_used_bonus)
-                # chain results may be filtered so test first
-                if chain_result:
-                    ready_for_action.append(chain_result)
+                # chain results may be filtered or split by random fills
+                chain_results.extend(
+                    self._simulated_chain_results(swap_result,
+                                                  already_used_bonus))
+            # the stack is last in first out so reverse to continue with the
+            # most promising swaps first
+            ready_for_action.extend(reversed(chain_results))
             #at this point all swaps have been tried
             #if nothing was valid, it's a manadrain
             if not tuple(ready_state.children):
-                mana_drain_eot = self._simulated_mana_drain(ready_state)
-                yield mana_drain_eot
+                for mana_drain_eot in self._simulated_mana_drain(ready_state):
+                    yield mana_drain_eot
                 continue
             # if something was valid, now spells can be simulated
             else:
                 pass
 
-    def ends_of_next_whole_turn(self, root):
+    def ends_of_next_whole_turn(self, root, branches=None, keep_going=None):
         """Simulate one complete turn to completion and generate each end of
         turn reached during the simulation.
 
@@ -331,6 +793,8 @@ class Game(object):
 
         Arguments:
         root: a start state with no parent
+        branches: optional children of root to continue. all by default
+        keep_going: see ends_of_one_state
         """
         # simple confirmation that the root is actually a root.
         # otherwise it may seem to work but would be totally out of spec
@@ -339,6 +803,13 @@ class Game(object):
                              ' root:\n{}'.format(root))
         # build the list of eots (or just the root if first turn) to be run
         leaves = list(root.leaves())
+        if branches is not None and leaves[0] is not root:
+            leaves = [leaf for branch in branches for leaf in branch.leaves()]
+        # only ends of turns can be continued
+        leaves = [leaf for leaf in leaves
+                  if leaf is root or isinstance(leaf, EOT)]
+        if not leaves:
+            return
         kw_starts = list()
         if leaves[0] is root:
             # build ends of state kwargs as only the root
@@ -346,12 +817,13 @@ class Game(object):
         else:
             # build ends of state kwargs as eots in the tree
             for leaf in leaves:
-                # ignore mana drains
-                if not leaf.is_mana_drain:
+                # ignore mana drains and finished games
+                if not (leaf.is_mana_drain or leaf.is_terminal):
                     kw_starts.append({'root_eot': leaf})
         # run a single turn for each starting point
         for kw_start in kw_starts:
-            for eot in self.ends_of_one_state(**kw_start):
+            for eot in self.ends_of_one_state(keep_going=keep_going,
+                                              **kw_start):
                 yield eot
 
     def all_ends_of_turn(self, root):
@@ -391,7 +863,7 @@ class Game(object):
                 kw_root = {'root_eot': start_eot}
             for eot in self.ends_of_one_state(**kw_root):
                 # only continue simulating non-mana drains
-                if not eot.is_mana_drain:
+                if not (eot.is_mana_drain or eot.is_terminal):
                     jobs.append(eot)
                 yield eot  # yield all eots including mana drains
 
@@ -410,64 +882,96 @@ class Game(object):
                             ' be an EOT transition:\n{}'.format(eot))
 
     def _simulated_swap_results(self, stable_state):
+        valid_swaps = list()
         for swap_pair in stable_state.board.potential_swaps():
             result_board, destroyed_groups = \
-                stable_state.board.execute_once(swap=swap_pair,
-                                                random_fill=self.random_fill)
+                stable_state.board.execute_once(swap=swap_pair)
             # ignore invalid swaps
             if not destroyed_groups:
                 continue  # discard this swap if it was invalid
-            # attach valid swap and result state
+            valid_swaps.append((swap_pair, result_board, destroyed_groups))
+        # most promising swaps first
+        valid_swaps = self.ordering.ordered(stable_state, valid_swaps)
+        # bound the cost of several actions in one turn by continuing only
+        # the most promising swaps after the first action of the turn
+        if self.beam_width and isinstance(stable_state.parent,
+                                          (Swap, ChainReaction, Chance)):
+            valid_swaps = valid_swaps[:self.beam_width]
+        # fill the results of all valid swaps at once
+        result_boards = [result_board for swap_pair, result_board,
+                         destroyed_groups in valid_swaps]
+        if (self.random_fill and self.expected_refill
+                and stable_state.parent is None):
+            expectations = [self._expected_refill_effects(result_board)
+                            for result_board in result_boards]
+            outcomes_by_swap = self._cascade_free_outcomes(stable_state.sims,
+                                                           result_boards)
+        else:
+            expectations = [None] * len(result_boards)
+            outcomes_by_swap = self._refilled_outcomes(stable_state.sims,
+                                                       result_boards)
+        for (swap_pair, result_board, destroyed_groups), outcomes, \
+                expectation in zip(valid_swaps, outcomes_by_swap,
+                                   expectations):
+            # attach valid swap and result state(s)
             swap = Swap(swap_pair)
             stable_state.graft_child(swap)
             bonus_action = any(len(group) >= 4
                                for group in destroyed_groups)
-            cls = stable_state.__class__
-            result_state = cls(board=result_board,
-                               turn=stable_state.turn,
-                               actions_remaining=
-                               stable_state.actions_remaining
-                               - 1 + bonus_action,
-                               player=stable_state.player.copy(),
-                               opponent=stable_state.opponent.copy())
-            # update the player and opponent
-            attack = \
-                result_state.active.apply_tile_groups(destroyed_groups)
-            result_state.passive.apply_attack(attack)
-            swap.graft_child(result_state)
-            yield result_state
-
-    def _simulated_chain_result(self, potential_chain, already_used_bonus):
-        """Simulate any chain reactions.
+            actions_remaining = \
+                stable_state.actions_remaining - 1 + bonus_action
+            for result_state in self._attached_results(swap, stable_state,
+                                                       outcomes,
+                                                       destroyed_groups,
+                                                       actions_remaining):
+                if expectation is not None:
+                    # like real tile effects, gains stop at the max values
+                    gains, attack = expectation
+                    active = result_state.active
+                    gains = numpy.minimum(active._values + gains,
+                                          active._maxima) - active._values
+                    swap.expected_refill = gains, attack
+                yield result_state
+
+    def _simulated_chain_results(self, potential_chain, already_used_bonus):
+        """Simulate any chain reactions and generate each final result.
 
         Arguments:
         potential_chain: a state to be tested for chain reactions
         already_used_bonus: boolean indicating whether a bonus turn was already
             applied during this action
 
-        Return: final result state or None (if state is filtered out in capture)
+        Generate: final result states. Nothing is generated for states that
+        are filtered out (capture). There is more than one result only when
+        random fills of different sims split the chain.
 
         Note that if there is no chain reaction, the final result is the
         same as the original state received.
         """
-        while potential_chain:
+        pending = [(potential_chain, already_used_bonus)]
+        while pending:
+            potential_chain, already_used_bonus = pending.pop()
             # hook for capture game optimizations. no effect in base
             # warning: only do this ONCE for any given state or it will
             # always filter the second time
             if self._disallow_state(potential_chain):
                 potential_chain.graft_child(Filtered())
-                return None  # no more simulation for this filtered state
+                continue  # no more simulation for this filtered state
+            # the game is over as soon as an actor is defeated
+            if self._is_terminal(potential_chain):
+                yield potential_chain
+                continue
             result_board, destroyed_groups = \
-                potential_chain.board.execute_once(random_fill=
-                                                   self.random_fill)
+                potential_chain.board.execute_once()
             # yield the state if nothing happened during execution (chain done)
             if not destroyed_groups:
                 # yield this state as the final result of the chain
-                return potential_chain
+                yield potential_chain
+                continue
             # attach the transition
             chain = ChainReaction()
             potential_chain.graft_child(chain)
-            # attach the result state
+            # attach the result state(s)
             if already_used_bonus:
                 # disallow bonus action if already applied
                 bonus_action = 0
@@ -476,20 +980,145 @@ class Game(object):
                 bonus_action = any(len(group) >= 4
                                    for group in destroyed_groups)
                 already_used_bonus = True
-            cls = potential_chain.__class__
-            chain_result = cls(board=result_board,
-                               turn=potential_chain.turn,
-                               actions_remaining=
-                               potential_chain.actions_remaining + bonus_action,
-                               player=potential_chain.player.copy(),
-                               opponent=potential_chain.opponent.copy())
-            # update the player and opponent
-            base_attack = \
-                chain_result.active.apply_tile_groups(destroyed_groups)
-            chain_result.passive.apply_attack(base_attack)
-            chain.graft_child(chain_result)
+            outcomes, = self._refilled_outcomes(potential_chain.sims,
+                                                (result_board,))
+            actions_remaining = potential_chain.actions_remaining + bonus_action
             # prepare to try for another chain reaction
-            potential_chain = chain_result
+            for chain_result in self._attached_results(chain, potential_chain,
+                                                       outcomes,
+                                                       destroyed_groups,
+                                                       actions_remaining):
+                pending.append((chain_result, already_used_bonus))
+
+    def _attached_results(self, transition, source_state, outcomes,
+                          destroyed_groups, actions_remaining):
+        """Attach and return a result state for each outcome of transition.
+
+        When the sims of source_state were split by random fills, each
+        result is attached under a Chance with the portion of sims in it.
+        """
+        source_sim_count = len(self._sim_ids(source_state.sims))
+        cls = source_state.__class__
+        results = list()
+        for sims, result_board in outcomes:
+            result_state = cls(board=result_board,
+                               turn=source_state.turn,
+                               actions_remaining=actions_remaining,
+                               player=source_state.player,
+                               opponent=source_state.opponent,
+                               arena=source_state.arena,
+                               sims=sims)
+            # update the player and opponent
+            attack = \
+                result_state.active.apply_tile_groups(destroyed_groups)
+            result_state.passive.apply_attack(attack)
+            if len(outcomes) > 1:
+                weight = float(len(self._sim_ids(sims))) / source_sim_count
+                chance = Chance(weight)
+                transition.graft_child(chance)
+                chance.graft_child(result_state)
+            else:
+                transition.graft_child(result_state)
+            results.append(result_state)
+        return results
+
+    def _refilled_outcomes(self, sims, boards):
+        """Randomly fill boards and return the distinct outcomes of each.
+
+        Each sim fills its own copy of the boards from its own random stream.
+        Sims that produce identical boards are merged into one outcome so
+        that its future is only simulated once.
+
+        Arguments:
+        sims: the sims (see State) that reached the boards
+        boards: boards with blanks after a destruction. filled in place
+
+        Return: for each board, a list of (sims, filled board) outcomes
+        """
+        sims = sims or self._all_sims
+        if not self.random_fill:
+            return [[(sims, board)] for board in boards]
+        sim_ids = self._sim_ids(sims)
+        # the first sim uses the originals so only the others need copies
+        boards_by_sim = [list(boards)]
+        boards_by_sim.extend([board.copy() for board in boards]
+                             for sim_id in sim_ids[1:])
+        for sim_id, sim_boards in zip(sim_ids, boards_by_sim):
+            self.fills[sim_id].fill_many(sim_boards)
+        return [self._merged_outcomes(sim_ids, filled_versions)
+                for filled_versions in zip(*boards_by_sim)]
+
+    def _merged_outcomes(self, sim_ids, boards):
+        """Return (sims, board) for each distinct board where boards has the
+        board of each sim in sim_ids."""
+        outcomes = list()
+        sims_by_key = dict()
+        for sim_id, board in zip(sim_ids, boards):
+            key = str(board)
+            if key in sims_by_key:
+                outcome_index = sims_by_key[key]
+                outcome_sims, outcome_board = outcomes[outcome_index]
+                outcomes[outcome_index] = (outcome_sims | 1 << sim_id,
+                                           outcome_board)
+            else:
+                sims_by_key[key] = len(outcomes)
+                outcomes.append((1 << sim_id, board))
+        return outcomes
+
+    def _cascade_free_outcomes(self, sims, boards):
+        """Fill boards without new matches and return them as the only
+        outcome for all sims. Same return value as _refilled_outcomes."""
+        sims = sims or self._all_sims
+        fill = self.fills[self._sim_ids(sims)[0]]
+        for board in boards:
+            fill.fill_without_cascade(board)
+        return [[(sims, board)] for board in boards]
+
+    def _expected_refill_effects(self, board):
+        """Return (stat gains, attack) expected from the cascades of the
+        refill of board for the actor that caused them."""
+        gains = numpy.zeros(len(_ACTOR_STATS))
+        attack = 0.0
+        for tile_type, count in self.fills[0].expected_cascade(board).items():
+            stat, tile_attack, multiplier = _TILE_EFFECTS[tile_type]
+            if stat is not None:
+                gains[stat] += count
+            attack += count * tile_attack
+        return gains, attack
+
+    def _sim_ids(self, sims):
+        """Return the index of each sim in the sims bit mask."""
+        sims = sims or self._all_sims
+        return [sim_id for sim_id in range(len(self.fills))
+                if sims & 1 << sim_id]
+
+    def _transposed_state(self, state, seen_states):
+        """Return an equivalent state already in seen_states or None if
+        state is new, in which case it is added to seen_states.
+
+        Equivalent states have the same board, actor values, actions
+        remaining and sims. States of different sims are kept apart since
+        their futures are filled by different random streams. An ancestor
+        is never returned.
+        """
+        key = (str(state.board), state.player._values.tobytes(),
+               state.opponent._values.tobytes(), state.actions_remaining,
+               state.sims or self._all_sims)
+        original = seen_states.setdefault(key, state)
+        if original is state:
+            return None
+        node = state.parent
+        while node is not None:
+            if node is original:
+                return None
+            node = node.parent
+        return original
+
+    def _is_terminal(self, state):
+        """Return True if either actor of state has been defeated. Actors
+        without health (e.g. capture) are never defeated."""
+        return any(actor.health <= 0 < actor.health_max
+                   for actor in (state.player, state.opponent))
 
     def _disallow_state(self, state):
         """Hook for capture game optimizations."""
@@ -498,40 +1127,118 @@ class Game(object):
         return False
 
     def _simulated_EOT(self, state):
-        """Simulate a normal or mana drain EOT and return it."""
+        """Simulate a normal or mana drain EOT and return a list of the
+        EOTs attached (see _simulated_mana_drain)."""
         # determine if this is a manadrain or just end of turn
         is_manadrain = True  # default mana drain until valid swap found
         for swap_pair in state.board.potential_swaps():
+            # no fill required. only the destructions of the swap matter
             result_board, destroyed_groups = \
-                state.board.execute_once(swap=swap_pair,
-                                         random_fill=self.random_fill)
+                state.board.execute_once(swap=swap_pair)
             if destroyed_groups:
                 is_manadrain = False
                 break  # stop when the first valid swap found
-        # attach appropriate EOT or ManaDrain
+        # attach a mana drain or a normal EOT
         if is_manadrain:
-            end = self._simulated_mana_drain(state)
-        else:
-            end = EOT(False)
-            state.graft_child(end)
-        return end
+            return self._simulated_mana_drain(state)
+        end = EOT(False)
+        state.graft_child(end)
+        return [end]
 
     def _simulated_mana_drain(self, mana_drain_state):
-        """Apply mana drain effects to this state, attach a mana drain EOT
-        and return the mana drain EOT."""
-        # clear all mana
-        mana_drain_state.player.apply_mana_drain()
-        mana_drain_state.opponent.apply_mana_drain()
-        # force change of turn
-        mana_drain_state.actions_remaining = 0
-        # randomize the board if this game uses random fill
+        """Apply mana drain effects, attach a mana drain EOT and return a
+        list of the mana drain EOTs.
+
+        Without random fill, the effects are applied to mana_drain_state.
+        With random fill, each sim draws its own random start board. The
+        drained results are attached to mana_drain_state by a ManaDrain
+        and split by Chance like the results of a refill.
+        """
         if self.random_fill:
-            random_start_board = mana_drain_state.board.random_start_board()
-            mana_drain_state.board = random_start_board
-        # attach the mana drain EOT
-        mana_drain = EOT(True)
-        mana_drain_state.graft_child(mana_drain)
-        return mana_drain
+            mana_drain = ManaDrain()
+            mana_drain_state.graft_child(mana_drain)
+            sim_ids = self._sim_ids(mana_drain_state.sims)
+            boards = [Board.random_start_board(self.fills[sim_id])
+                      for sim_id in sim_ids]
+            drained_states = self._attached_results(
+                mana_drain, mana_drain_state,
+                self._merged_outcomes(sim_ids, boards), (), 0)
+        else:
+            drained_states = [mana_drain_state]
+        ends = list()
+        for drained_state in drained_states:
+            # clear all mana
+            drained_state.player.apply_mana_drain()
+            drained_state.opponent.apply_mana_drain()
+            # force change of turn
+            drained_state.actions_remaining = 0
+            # attach the mana drain EOT
+            end = EOT(True)
+            drained_state.graft_child(end)
+            ends.append(end)
+        return ends
+
+
+class SwapOrdering(object):
+    """Rank valid swaps from most to least promising before they are
+    expanded so that any search finds good swaps early.
+
+    Swaps are ranked by, in order of priority:
+    - extra action (any group of 4 or more)
+    - skull damage
+    - mana, xp, etc. the active actor can actually use (not over max)
+    - total destroyed tiles
+    - killer: the swap was recently chosen in another state of the turn
+    - history: how often the swap was rewarded during the search so far
+    """
+    # killer swaps remembered for each turn
+    KILLERS_PER_TURN = 2
+
+    def __init__(self):
+        self._history = dict()
+        self._killers = dict()  # turn: most recently rewarded swap pairs
+
+    def ordered(self, state, valid_swaps):
+        """Return valid_swaps sorted from most to least promising.
+
+        Arguments:
+        state: the stable state in which the swaps are made
+        valid_swaps: sequence of (swap pair, result board, destroyed groups)
+        """
+        active = state.active
+        killers = self._killers.get(state.turn, ())
+        keys = dict()
+        for swap_pair, result_board, destroyed_groups in valid_swaps:
+            keys[swap_pair] = self._key(active, swap_pair, destroyed_groups,
+                                        killers)
+        return sorted(valid_swaps, key=lambda valid_swap: keys[valid_swap[0]],
+                      reverse=True)
+
+    def reward(self, swap_pair, amount=1, turn=None):
+        """Record that swap_pair was a good choice somewhere in the search.
+
+        Arguments:
+        turn: optional turn in which swap_pair was chosen. it is then also
+            a killer swap for the other states of that turn.
+        """
+        self._history[swap_pair] = self._history.get(swap_pair, 0) + amount
+        if turn is not None:
+            killers = self._killers.setdefault(turn, list())
+            if swap_pair in killers:
+                killers.remove(swap_pair)
+            killers.insert(0, swap_pair)
+            del killers[self.KILLERS_PER_TURN:]
+
+    def _key(self, active, swap_pair, destroyed_groups, killers=()):
+        bonus_action = any(len(group) >= 4 for group in destroyed_groups)
+        # apply the groups to a copy of the actor to get the usable gains
+        actor = active.copy()
+        attack = actor.apply_tile_groups(destroyed_groups)
+        usable_gains = int((actor._values - active._values)[1:].sum())
+        tile_count = sum(len(group) for group in destroyed_groups)
+        killer = swap_pair in killers
+        history = self._history.get(swap_pair, 0)
+        return bonus_action, attack, usable_gains, tile_count, killer, history
 
 
 class Tile(object):
@@ -604,7 +1311,7 @@ class Tile(object):
     def random_tile(cls):
         """Return a random tile based on _random_weights distribution."""
         random_type = random.choice(cls._random_distribution)
-        return cls(random_type)
+        return cls.singleton(random_type)
 
     # Special methods
     def __str__(self):
@@ -658,6 +1365,110 @@ class Tile(object):
         return tile
 
 
+class RandomFill(object):
+    """Fill the blanks of boards with random tiles in batches.
+
+    Tiles are drawn according to Tile._random_weights from a random stream
+    owned by this object. Seed it to reproduce a simulation and use one
+    object per simulation to keep the streams independent.
+    """
+    def __init__(self, seed=None):
+        self._random = numpy.random.RandomState(seed)
+        tile_types = sorted(Tile._random_weights.keys())
+        weights = numpy.array([Tile._random_weights[tile_type]
+                               for tile_type in tile_types], dtype=float)
+        self._probabilities = weights / weights.sum()
+        self._tiles = numpy.empty(len(tile_types), dtype=object)
+        self._tiles[:] = [Tile.singleton(t) for t in tile_types]
+
+    def fill(self, board):
+        """Fill all blanks of board in place."""
+        self.fill_many((board,))
+
+    def fill_many(self, boards):
+        """Fill all blanks of every board in place with one random draw."""
+        blank = Tile.singleton('.')
+        blank_maps = [board._array == blank for board in boards]
+        total_blanks = sum(int(blank_map.sum()) for blank_map in blank_maps)
+        if not total_blanks:
+            return
+        choices = self._random.choice(len(self._tiles), size=total_blanks,
+                                      p=self._probabilities)
+        new_tiles = self._tiles[choices]
+        start = 0
+        for board, blank_map in zip(boards, blank_maps):
+            end = start + int(blank_map.sum())
+            board._array[blank_map] = new_tiles[start:end]
+            start = end
+
+    def fill_without_cascade(self, board, attempts=10):
+        """Fill all blanks of board in place so that no new tiles are part
+        of a line of 3 of the same type. Return True if that was possible
+        within attempts or False with the last fill kept anyway."""
+        blank = Tile.singleton('.')
+        blank_map = board._array == blank
+        for attempt in range(attempts):
+            self.fill(board)
+            types = numpy.array([[tile._type for tile in row]
+                                 for row in board._array])
+            if not any(new_lines.any() for new_lines
+                       in self._new_lines(types, blank_map)):
+                return True
+            if attempt < attempts - 1:
+                board._array[blank_map] = blank
+        return False
+
+    def expected_cascade(self, board):
+        """Return a dict of the expected number of tiles of each random type
+        that new matches would destroy after filling the blanks of board.
+
+        This is a semi-analytical estimate based on Tile._random_weights.
+        Each line of 3 positions that includes a blank is counted on its own
+        (overlapping lines are not merged) and only exact type matches are
+        considered (no wildcards).
+        """
+        blank_map = board._array == Tile.singleton('.')
+        # probability of each position having each type after filling
+        odds = numpy.empty(board._array.shape + (len(self._tiles),))
+        for i, tile in enumerate(self._tiles):
+            odds[..., i] = board._array == tile
+        odds[blank_map] = self._probabilities
+        expected = numpy.zeros(len(self._tiles))
+        for line_odds, line_map in zip(self._lines(odds),
+                                       self._lines(blank_map)):
+            line_map = line_map[0] | line_map[1] | line_map[2]
+            all_same = line_odds[0] * line_odds[1] * line_odds[2]
+            expected += 3 * all_same[line_map].sum(axis=0)
+        return dict((tile._type, count)
+                    for tile, count in zip(self._tiles, expected))
+
+    def _new_lines(self, types, blank_map):
+        """Generate a map of lines of 3 equal types that include a blank of
+        blank_map for horizontal and then vertical lines."""
+        for line_types, line_map in zip(self._lines(types),
+                                        self._lines(blank_map)):
+            yield ((line_types[0] == line_types[1])
+                   & (line_types[1] == line_types[2])
+                   & (line_map[0] | line_map[1] | line_map[2]))
+
+    @staticmethod
+    def _lines(values):
+        """Return the 3 offset views of values that make up all horizontal
+        and then all vertical lines of 3 positions."""
+        horizontal = values[:, :-2], values[:, 1:-1], values[:, 2:]
+        vertical = values[:-2], values[1:-1], values[2:]
+        return horizontal, vertical
+
+    def spawn_seeds(self, count):
+        """Return seeds for count new streams drawn from this stream."""
+        return [int(seed) for seed in self._random.randint(2 ** 31 - 1,
+                                                            size=count)]
+
+
+# fill used when a board is not given one. seeded from the system
+_default_fill = RandomFill()
+
+
 class Board(object):
     """Behaves like a PQ board."""
     def __init__(self, board_string=None):
@@ -676,26 +1487,32 @@ class Board(object):
 
     # Class methods
     @classmethod
-    def random_start_board(cls):
-        """Produce a full, stable start board with random tiles."""
+    def random_start_board(cls, fill=None):
+        """Produce a full, stable start board with random tiles.
+
+        Arguments:
+        fill: optional RandomFill to provide the random tiles
+        """
         board = cls()
-        board._random_fill()
+        board._random_fill(fill)
         destructions = True  # prime the loop
         while destructions:
             board, destructions = board.execute_once()
-            board._random_fill()
+            board._random_fill(fill)
         return board
 
     # Execution Methods (Core behavior)
     def execute_once(self, swap=None,
                      spell_changes=None, spell_destructions=None,
-                     random_fill=False):
+                     random_fill=False, fill=None):
         """Execute the board only one time. Do not execute chain reactions.
 
         Arguments:
         swap - pair of adjacent positions
         spell_changes - sequence of (position, tile) changes
         spell_destructions - sequence of positions to be destroyed
+        random_fill - True/False to fill blanks with random tiles or not
+        fill - optional RandomFill to provide the random tiles
 
         Return: (copy of the board, destroyed tile groups)
         """
@@ -719,7 +1536,7 @@ class Board(object):
         total_destroyed_tile_groups.extend(destroyed_tile_groups)
         bcopy._fall()
         if random_fill:
-            bcopy._random_fill()
+            bcopy._random_fill(fill)
         return bcopy, total_destroyed_tile_groups
 
     def _swap(self, swap):
@@ -888,12 +1705,13 @@ class Board(object):
                         #in any case, move on to the next target position
                 target_p -= 1
 
-    def _random_fill(self):
-        """Fill the board with random tiles based on the Tile class."""
-        a = self._array
-        for p, tile in self.positions_with_tile():
-            if tile.is_blank():
-                a[p] = Tile.random_tile()
+    def _random_fill(self, fill=None):
+        """Fill the board with random tiles based on the Tile class.
+
+        Arguments:
+        fill: optional RandomFill to provide the random tiles
+        """
+        (fill or _default_fill).fill(self)
 
     # Special Methods
     def __str__(self):
@@ -1000,75 +1818,114 @@ class Board(object):
         self._array[key] = value
 
 
+# order and storage type of the current and max values of an actor
+_ACTOR_STATS = ('health', 'r', 'g', 'b', 'y', 'x', 'm', 'h', 'c')
+_STAT_DTYPE = numpy.int32
+_MANA = slice(1, 5)  # r, g, b, y
+
+
+def _tile_effects():
+    """Return (increased stat index, attack, multiplier) for each tile type."""
+    effects = {tile_type: (None, 0, 1) for tile_type in Tile._all_types}
+    for tile_type in ('r', 'g', 'b', 'y', 'x', 'm', 'h', 'c'):
+        effects[tile_type] = (_ACTOR_STATS.index(tile_type), 0, 1)
+    for tile_type in ('2', '3', '4', '5', '6', '7', '8', '9'):
+        effects[tile_type] = (None, 0, int(tile_type))
+    effects['s'] = (None, 1, 1)
+    effects['*'] = (None, 5, 1)
+    return effects
+
+_TILE_EFFECTS = _tile_effects()
+
+
+def _actor_stat(name):
+    """Make a property for one current value limited to [0, max]."""
+    index = _ACTOR_STATS.index(name)
+
+    def get_stat(self):
+        return int(self._values[index])
+
+    def set_stat(self, value):
+        self._values[index] = max(0, min(self._maxima[index], value))
+    return property(get_stat, set_stat)
+
+
+def _actor_stat_max(name):
+    """Make a property for one max value. The max values of the actors of
+    states are shared by the whole simulation so they can't be set."""
+    index = _ACTOR_STATS.index(name)
+
+    def get_stat_max(self):
+        return int(self._maxima[index])
+
+    def set_stat_max(self, value):
+        if not self._maxima.flags.writeable:
+            raise AttributeError('The max values of the actors of a'
+                                 ' simulation are shared by all of its'
+                                 ' states and can not be changed.')
+        self._maxima[index] = value
+    return property(get_stat_max, set_stat_max)
+
+
 class Actor(object):
+    __slots__ = ('name', '_values', '_maxima')
+
     def __init__(self, name, health, r, g, b, y, x, m, h, c):
         """Provide current and max as a tuple for each of health, etc."""
         self.name = name
-        self._health, self.health_max = health
-        self._r, self.r_max = r
-        self._g, self.g_max = g
-        self._b, self.b_max = b
-        self._y, self.y_max = y
-        self._x, self.x_max = x
-        self._m, self.m_max = m
-        self._h, self.h_max = h
-        self._c, self.c_max = c
+        currents, maxima = zip(health, r, g, b, y, x, m, h, c)
+        self._values = numpy.array(currents, dtype=_STAT_DTYPE)
+        self._maxima = numpy.array(maxima, dtype=_STAT_DTYPE)
+
+    @classmethod
+    def _view(cls, name, values, maxima):
+        """Return an actor that works directly on the given value arrays.
+
+        This allows a StateArena to provide actors without copying its rows.
+        """
+        actor = cls.__new__(cls)
+        actor.name = name
+        actor._values = values
+        actor._maxima = maxima
+        return actor
 
     def copy(self):
         """Return a copy of this actor with the same attribute values."""
-        health = self.health, self.health_max
-        r = self.r, self.r_max
-        g = self.g, self.g_max
-        b = self.b, self.b_max
-        y = self.y, self.y_max
-        x = self.x, self.x_max
-        m = self.m, self.m_max
-        h = self.h, self.h_max
-        c = self.c, self.c_max
-        return self.__class__(self.name, health, r, g, b, y, x, m, h, c)
+        return self._view(self.name, self._values.copy(),
+                          self._maxima.copy())
 
     def apply_mana_drain(self):
         """Clear current mana values."""
-        self.r = self.g = self.b = self.y = 0
+        self._values[_MANA] = 0
 
     def apply_tile_groups(self, tile_groups):
-        """Increase mana, xp, money, anvils and scrolls based on tile groups."""
-        self_increase_types = ('r', 'g', 'b', 'y', 'x', 'm', 'h', 'c')
-        attack_types = ('s', '*')
+        """Increase mana, xp, money, anvils and scrolls based on tile groups.
+
+        Increases for all groups are collected first and then applied to
+        the current values in one step.
+        """
+        gains = numpy.zeros(len(_ACTOR_STATS), dtype=_STAT_DTYPE)
         total_attack = 0
         for tile_group in tile_groups:
-            group_type = None
+            group_stat = None
+            group_type_found = False
             type_count = 0
             type_multiplier = 1
             for tile in tile_group:
-                # try to get the group type
-                if not group_type:
-                    # try to set the group type to a non-wildcard type
-                    if tile._type in self_increase_types:
-                        group_type = tile._type
-                    elif tile._type in attack_types:
-                        group_type = 's'  # always use base skull
-                # handle special case of wildcard
-                if tile.is_wildcard():
-                    type_multiplier *= int(tile._type)
-                    continue  # done with this tile
-                # handle special case of skullbomb / skull
-                elif tile.is_skullbomb():
-                    total_attack += 5
-                    continue
-                elif tile.is_skull():
-                    total_attack += 1
-                    continue
-                # handle standard case of normal tiles
-                else:
+                stat, attack, multiplier = _TILE_EFFECTS[tile._type]
+                # the first non-wildcard tile decides the group type
+                if not group_type_found and multiplier == 1:
+                    group_stat = stat
+                    group_type_found = stat is not None or attack > 0
+                type_multiplier *= multiplier
+                total_attack += attack
+                if stat is not None:
                     type_count += 1
-            if group_type is None:
-                continue  # ignore this group. could be all wildcards or empty
-            # adjust self value
-            if type_count:
-                new_value = type_count * type_multiplier
-                original = getattr(self, group_type)
-                setattr(self, group_type, original + new_value)
+            # ignore groups with no type. could be all wildcards or skulls
+            if group_stat is not None and type_count:
+                gains[group_stat] += type_count * type_multiplier
+        # increases can only exceed the max, never go below zero
+        numpy.minimum(self._values + gains, self._maxima, out=self._values)
         # return any attack value
         return total_attack
 
@@ -1076,90 +1933,244 @@ class Actor(object):
         """Apply the attack to health."""
         self.health -= attack_value
 
-    def __limit_range(self, value, minimum, maximum):
-        return max(minimum, min(maximum, value))
+    def __eq__(self, other):
+        """Equal when name, current values and max values are all equal."""
+        try:
+            return (self.name == other.name
+                    and numpy.array_equal(self._values, other._values)
+                    and numpy.array_equal(self._maxima, other._maxima))
+        except AttributeError:
+            return False
 
-    @property
-    def health(self):
-        return self._health
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
-    @health.setter
-    def health(self, value):
-        self._health = self.__limit_range(value, 0, self.health_max)
+    health = _actor_stat('health')
+    r = _actor_stat('r')
+    g = _actor_stat('g')
+    b = _actor_stat('b')
+    y = _actor_stat('y')
+    x = _actor_stat('x')
+    m = _actor_stat('m')
+    h = _actor_stat('h')
+    c = _actor_stat('c')
+
+    health_max = _actor_stat_max('health')
+    r_max = _actor_stat_max('r')
+    g_max = _actor_stat_max('g')
+    b_max = _actor_stat_max('b')
+    y_max = _actor_stat_max('y')
+    x_max = _actor_stat_max('x')
+    m_max = _actor_stat_max('m')
+    h_max = _actor_stat_max('h')
+    c_max = _actor_stat_max('c')
+
+
+class StateArena(object):
+    """Structure-of-arrays storage for all states of one simulation tree.
+
+    Each state is only a node id. Its board, actor values, turn and actions
+    remaining are stored in numpy arrays indexed by that id. Max actor values
+    never change during a simulation so they are stored once for the tree.
+
+    Note on growth:
+    Storage grows by fixed size blocks rather than reallocating so that
+    views of any row (e.g. the actors of a state) stay valid. Rows of
+    released states are reused before the storage grows.
+    """
+    _BLOCK_SIZE = 1024
+
+    def __init__(self, player, opponent):
+        self._names = player.name, opponent.name
+        self._maxima = numpy.array((player._maxima, opponent._maxima),
+                                   dtype=_STAT_DTYPE)
+        self._maxima.flags.writeable = False
+        self._boards = list()   # blocks of board references
+        self._stats = list()    # blocks of (player, opponent) current values
+        self._turns = list()
+        self._actions = list()
+        self._sims = list()
+        self._size = 0
+        self._released = list()  # node ids of rows available for reuse
+
+    def __len__(self):
+        """Return the number of stored states."""
+        return self._size - len(self._released)
 
     @property
-    def r(self):
-        return self._r
-
-    @r.setter
-    def r(self, value):
-        self._r = self.__limit_range(value, 0, self.r_max)
+    def maxima(self):
+        """Read-only (player, opponent) max values of every state."""
+        return self._maxima
+
+    def add(self, board, player, opponent, turn, actions_remaining, sims=0):
+        """Store a new state and return its node id."""
+        if self._released:
+            node_id = self._released.pop()
+        else:
+            node_id = self._size
+            self._size += 1
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        if block == len(self._stats):
+            self._add_block()
+        self._boards[block][row] = board
+        self._stats[block][row, 0] = player._values
+        self._stats[block][row, 1] = opponent._values
+        self._turns[block][row] = turn
+        self._actions[block][row] = actions_remaining
+        self._sims[block][row] = sims
+        return node_id
+
+    def release(self, node_ids):
+        """Make the rows of node_ids available to new states. The states
+        of node_ids must not be used afterwards."""
+        for node_id in node_ids:
+            block, row = divmod(node_id, self._BLOCK_SIZE)
+            self._boards[block][row] = None  # let the board go
+        self._released.extend(node_ids)
+
+    def _add_block(self):
+        size = self._BLOCK_SIZE
+        self._boards.append(numpy.empty(size, dtype=object))
+        self._stats.append(numpy.zeros((size, 2, len(_ACTOR_STATS)),
+                                       dtype=_STAT_DTYPE))
+        self._turns.append(numpy.zeros(size, dtype=numpy.int16))
+        self._actions.append(numpy.zeros(size, dtype=numpy.int8))
+        self._sims.append(numpy.zeros(size, dtype=numpy.int64))
+
+    # Access to one state
+    def board(self, node_id):
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        return self._boards[block][row]
+
+    def set_board(self, node_id, board):
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        self._boards[block][row] = board
+
+    def turn(self, node_id):
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        return int(self._turns[block][row])
+
+    def set_turn(self, node_id, turn):
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        self._turns[block][row] = turn
+
+    def actions_remaining(self, node_id):
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        return int(self._actions[block][row])
+
+    def set_actions_remaining(self, node_id, actions_remaining):
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        self._actions[block][row] = actions_remaining
+
+    def sims(self, node_id):
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        return int(self._sims[block][row])
+
+    def set_sims(self, node_id, sims):
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        self._sims[block][row] = sims
+
+    def stats(self, node_ids):
+        """Return a copy of the (player, opponent) current values of each
+        node id as one array."""
+        node_ids = numpy.asarray(node_ids, dtype=numpy.intp)
+        blocks, rows = numpy.divmod(node_ids, self._BLOCK_SIZE)
+        stats = numpy.empty((len(node_ids), 2, len(_ACTOR_STATS)),
+                            dtype=_STAT_DTYPE)
+        for block in numpy.unique(blocks):
+            in_block = blocks == block
+            stats[in_block] = self._stats[block][rows[in_block]]
+        return stats
+
+    def actors(self, node_id):
+        """Return (player, opponent) that work in place on the arena."""
+        block, row = divmod(node_id, self._BLOCK_SIZE)
+        stats = self._stats[block][row]
+        return tuple(Actor._view(self._names[i], stats[i], self._maxima[i])
+                     for i in (0, 1))
 
-    @property
-    def g(self):
-        return self._g
 
-    @g.setter
-    def g(self, value):
-        self._g = self.__limit_range(value, 0, self.g_max)
+class State(TreeNode):
+    def __init__(self, board, player, opponent, turn, actions_remaining,
+                 arena=None, sims=0):
+        """Store the state in arena or in a new arena (i.e. a new tree).
 
-    @property
-    def b(self):
-        return self._b
+        The values of player and opponent are copied into the arena so they
+        can be the actors of another state.
 
-    @b.setter
-    def b(self, value):
-        self._b = self.__limit_range(value, 0, self.b_max)
+        Arguments:
+        sims: bit mask of the simulations that reached this state when
+            several are run in one tree. 0 means all of them.
+        """
+        super(State, self).__init__()
+        if arena is None:
+            arena = StateArena(player, opponent)
+        self._arena = arena
+        self._node_id = arena.add(board, player, opponent,
+                                  turn, actions_remaining, sims)
+        self._actors = None  # views are made on first access
 
     @property
-    def y(self):
-        return self._y
+    def arena(self):
+        return self._arena
 
-    @y.setter
-    def y(self, value):
-        self._y = self.__limit_range(value, 0, self.y_max)
+    @property
+    def node_id(self):
+        return self._node_id
 
     @property
-    def x(self):
-        return self._x
+    def board(self):
+        return self._arena.board(self._node_id)
 
-    @x.setter
-    def x(self, value):
-        self._x = self.__limit_range(value, 0, self.x_max)
+    @board.setter
+    def board(self, board):
+        self._arena.set_board(self._node_id, board)
 
     @property
-    def m(self):
-        return self._m
+    def turn(self):
+        return self._arena.turn(self._node_id)
 
-    @m.setter
-    def m(self, value):
-        self._m = self.__limit_range(value, 0, self.m_max)
+    @turn.setter
+    def turn(self, turn):
+        self._arena.set_turn(self._node_id, turn)
 
     @property
-    def h(self):
-        return self._h
+    def actions_remaining(self):
+        return self._arena.actions_remaining(self._node_id)
 
-    @h.setter
-    def h(self, value):
-        self._h = self.__limit_range(value, 0, self.h_max)
+    @actions_remaining.setter
+    def actions_remaining(self, actions_remaining):
+        self._arena.set_actions_remaining(self._node_id, actions_remaining)
 
     @property
-    def c(self):
-        return self._c
+    def sims(self):
+        return self._arena.sims(self._node_id)
 
-    @c.setter
-    def c(self, value):
-        self._c = self.__limit_range(value, 0, self.c_max)
+    @sims.setter
+    def sims(self, sims):
+        self._arena.set_sims(self._node_id, sims)
 
+    @property
+    def player(self):
+        return self._actor_views()[0]
 
-class State(TreeNode):
-    def __init__(self, board, player, opponent, turn, actions_remaining):
-        super(State, self).__init__()
-        self.board = board
-        self.player = player
-        self.opponent = opponent
-        self.turn = turn
-        self.actions_remaining = actions_remaining
+    @property
+    def opponent(self):
+        return self._actor_views()[1]
+
+    def move_to(self, arena):
+        """Store the values of this state in arena from now on. This allows
+        keeping part of a tree without the storage of the rest of it."""
+        player, opponent = self._actor_views()
+        self._node_id = arena.add(self.board, player, opponent, self.turn,
+                                  self.actions_remaining, self.sims)
+        self._arena = arena
+        self._actors = None
+
+    def _actor_views(self):
+        if self._actors is None:
+            self._actors = self._arena.actors(self._node_id)
+        return self._actors
 
     # Additional turn information
     @property
@@ -1206,6 +2217,8 @@ class Swap(BaseTransition):
     def __init__(self, position_pair):
         super(Swap, self).__init__()
         self._position_pair = position_pair
+        # (stat gains, attack) estimated for the refill when not sampled
+        self.expected_refill = None
 
     def __str__(self):
         base = super(Swap, self).__str__()
@@ -1220,15 +2233,37 @@ class ChainReaction(BaseTransition):
     pass
 
 
+class ManaDrain(BaseTransition):
+    """The active actor had no valid swap so the board is replaced by a
+    random start board and all mana is lost."""
+
+
+class Chance(BaseTransition):
+    """One of several distinct random outcomes of the parent transition."""
+    def __init__(self, weight):
+        super(Chance, self).__init__()
+        self.weight = weight
+
+    def __str__(self):
+        s = super(Chance, self).__str__()
+        return s + ' (weight: {:.2f})'.format(self.weight)
+
+
 class EOT(BaseTransition):
-    def __init__(self, is_mana_drain):
+    def __init__(self, is_mana_drain, is_terminal=False):
+        """Arguments:
+        is_terminal: True when an actor was defeated so the game is over
+        """
         super(EOT, self).__init__()
         self.is_mana_drain = is_mana_drain
+        self.is_terminal = is_terminal
 
     def __str__(self):
         s = super(EOT, self).__str__()
         if self.is_mana_drain:
             s += ' (mana drain)'
+        if self.is_terminal:
+            s += ' (terminal)'
         return s
 
 
@@ -1236,5 +2271,13 @@ class Filtered(BaseTransition):
     pass
 
 
+class Transposition(BaseTransition):
+    """The parent state is equivalent to another state of the same turn
+    which is simulated instead."""
+    def __init__(self, state):
+        super(Transposition, self).__init__()
+        self.state = state
+
+
 if __name__ == "__main__":
     pass
@@ -1,29 +1,186 @@
+import hashlib
 from os import path
+import struct
+import warnings
+import zipfile
 
-from investigators.visuals import cv2
+import numpy
 
 _base = path.abspath(path.split(__file__)[0])
 
-capture_template = cv2.imread(path.join(_base, 'capture template 1280x960.png'))
-versus_template = cv2.imread(path.join(_base, 'versus template 1280x960.png'))
-extra_action_template = cv2.imread(path.join(_base,
-                                             'extra action template.png'))
-
-tile_templates = {'.': cv2.imread(path.join(_base, '_.png')),
-                  'r': cv2.imread(path.join(_base, 'r.png')),
-                  'g': cv2.imread(path.join(_base, 'g.png')),
-                  'b': cv2.imread(path.join(_base, 'b.png')),
-                  'y': cv2.imread(path.join(_base, 'y.png')),
-                  'x': cv2.imread(path.join(_base, 'x.png')),
-                  'm': cv2.imread(path.join(_base, 'm.png')),
-                  's': cv2.imread(path.join(_base, 's.png')),
-                  '*': cv2.imread(path.join(_base, '@.png')),
-                  'c': cv2.imread(path.join(_base, 'c.png')),
-                  'h': cv2.imread(path.join(_base, 'h.png')),
-                  '2': cv2.imread(path.join(_base, '2.png')),
-                  '3': cv2.imread(path.join(_base, '3.png')),
-                  '4': cv2.imread(path.join(_base, '4.png')),
-                  '5': cv2.imread(path.join(_base, '5.png')),
-                  '6': cv2.imread(path.join(_base, '6.png')),
-                  '7': cv2.imread(path.join(_base, '7.png')),
-                  '8': cv2.imread(path.join(_base, '8.png'))}
+# optional single file with every template and its pre-scaled variants.
+# see build_pack
+PACK_PATH = path.join(_base, 'templates.npz')
+# pack entry with the digest of the images it was built from
+_DIGEST_KEY = 'source digest'
+
+# images are only read when first used so that importing stays cheap
+_images = dict()
+_pack = None  # memory mapped images in the pack by key once it is opened
+
+_FILENAMES = {'capture': 'capture template 1280x960.png',
+              'versus': 'versus template 1280x960.png',
+              'extra_action': 'extra action template.png',
+              'tile .': '_.png',
+              'tile r': 'r.png',
+              'tile g': 'g.png',
+              'tile b': 'b.png',
+              'tile y': 'y.png',
+              'tile x': 'x.png',
+              'tile m': 'm.png',
+              'tile s': 's.png',
+              'tile *': '@.png',
+              'tile c': 'c.png',
+              'tile h': 'h.png',
+              'tile 2': '2.png',
+              'tile 3': '3.png',
+              'tile 4': '4.png',
+              'tile 5': '5.png',
+              'tile 6': '6.png',
+              'tile 7': '7.png',
+              'tile 8': '8.png'}
+
+
+def capture_template(size=None):
+    """Return the capture template. see _image for size."""
+    return _image('capture', size)
+
+
+def versus_template(size=None):
+    """Return the versus template. see _image for size."""
+    return _image('versus', size)
+
+
+def extra_action_template(size=None):
+    """Return the extra action template. see _image for size."""
+    return _image('extra_action', size)
+
+
+def tile_templates():
+    """Return a dict of tile character: tile image."""
+    return dict((name[-1], _image(name)) for name in _FILENAMES
+                if name.startswith('tile '))
+
+
+def build_pack(sizes, pack_path=PACK_PATH):
+    """Write every template and the given resized variants into one
+    uncompressed archive. When it exists, templates are memory mapped from
+    it instead of decoding and resizing the images in every process.
+    A pack built from other images is ignored with a warning so build it
+    again whenever the images change:
+
+        python setup.py build_templates
+
+    Arguments:
+    - sizes: dict of template name: sequence of (rows, columns) variants
+    """
+    global _pack
+    originals = dict((name, _read(name)) for name in _FILENAMES)
+    arrays = dict(originals)
+    for name, variant_sizes in sizes.items():
+        for size in variant_sizes:
+            arrays[_key(name, size)] = _resized(originals[name], size)
+    arrays[_DIGEST_KEY] = _source_digest()
+    numpy.savez(pack_path, **arrays)
+    # use the new pack from now on
+    _images.clear()
+    _pack = None
+
+
+def _image(name, size=None):
+    """Return the named template. It is read only the first time.
+
+    Arguments:
+    - size: optional (rows, columns) to resize to. it is resized only the
+        first time unless the pack already has it.
+    """
+    key = _key(name, size)
+    if key not in _images:
+        pack = _template_pack()
+        if key in pack:
+            _images[key] = pack[key]
+        elif size is None:
+            _images[key] = _read(name)
+        else:
+            _images[key] = _resized(_image(name), size)
+    return _images[key]
+
+
+def _key(name, size):
+    if size is None:
+        return name
+    return '{} {}x{}'.format(name, *size)
+
+
+def _read(name):
+    from investigators.visuals import cv2
+    return cv2.imread(path.join(_base, _FILENAMES[name]))
+
+
+def _resized(image, size):
+    """Resize the same way as investigators' TemplateFinder."""
+    from investigators.visuals import cv2
+    h, w = size
+    if h > image.shape[0]:
+        interpolation = cv2.INTER_CUBIC  # enlarging
+    else:
+        interpolation = cv2.INTER_AREA  # shrinking
+    return cv2.resize(image, (w, h), interpolation=interpolation)
+
+
+def _template_pack():
+    """Return the memory mapped images in the pack (empty without one or
+    when it was built from other images)."""
+    global _pack
+    if _pack is None:
+        _pack = dict()
+        if path.exists(PACK_PATH):
+            pack = _mapped_arrays(PACK_PATH)
+            digest = pack.pop(_DIGEST_KEY, None)
+            if digest is not None and numpy.array_equal(digest,
+                                                         _source_digest()):
+                _pack = pack
+            else:
+                warnings.warn('Ignoring {} since it was not built from the'
+                              ' current template images. Build it again'
+                              ' with: python setup.py build_templates'
+                              ''.format(PACK_PATH))
+    return _pack
+
+
+def _source_digest():
+    """Return the digest of every template image file as an array."""
+    digest = hashlib.sha1()
+    for name in sorted(_FILENAMES):
+        with open(path.join(_base, _FILENAMES[name]), 'rb') as image_file:
+            digest.update(image_file.read())
+    return numpy.frombuffer(digest.digest(), dtype=numpy.uint8)
+
+
+def _mapped_arrays(npz_path):
+    """Return a dict of each array in an uncompressed npz file mapped
+    directly from the file instead of read into memory."""
+    with zipfile.ZipFile(npz_path) as archive:
+        members = archive.infolist()
+    arrays = dict()
+    with open(npz_path, 'rb') as npz_file:
+        for member in members:
+            if member.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('Unable to map compressed {} in {}.'
+                                 ''.format(member.filename, npz_path))
+            # skip the zip header of the member and then the npy header
+            npz_file.seek(member.header_offset)
+            zip_header = npz_file.read(30)
+            name_length, extra_length = struct.unpack('<HH', zip_header[26:])
+            npz_file.seek(name_length + extra_length, 1)
+            version = numpy.lib.format.read_magic(npz_file)
+            if version == (1, 0):
+                read_header = numpy.lib.format.read_array_header_1_0
+            else:
+                read_header = numpy.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(npz_file)
+            name = path.splitext(member.filename)[0]
+            arrays[name] = numpy.memmap(npz_path, dtype=dtype, mode='r',
+                                        offset=npz_file.tell(), shape=shape,
+                                        order='F' if fortran_order else 'C')
+    return arrays
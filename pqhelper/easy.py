@@ -1,11 +1,17 @@
+import time
+
 from pqhelper import base, capture, versus
 
 
 # these parts are heavy so keep one common object for the module
 _state_investigator = base.StateInvestigator()
+# keep the versus advisor between analyses to reuse its simulations
+_versus_advisor = None
 
 
-def versus_summaries(turns=2, sims_to_average=2, async_results_q=None):
+def versus_summaries(turns=2, sims_to_average=2, async_results_q=None,
+                     seed=None, keep_fraction=0.5, beam_width=None,
+                     keep_going=None, expected_refill=False):
     """Return summaries of the likely resutls of each available action..
 
     Arguments:
@@ -14,48 +20,206 @@ def versus_summaries(turns=2, sims_to_average=2, async_results_q=None):
     - sims_to_average: how many times to run the simulation
         to get more representative average results of each action.
     - async_results_q: provide a multiprocessing Queue on which
-        the summaries of each turn will be placed. this is an asynchronous
-        alternative to waiting for the final return value
+        the changes to the summaries after each turn will be placed. this
+        is an asynchronous alternative to waiting for the final return
+        value. see apply_summary_deltas for the format
+    - seed: optional seed to reproduce the random fills of all simulations.
+        each simulation still gets its own independent stream. simulations
+        from previous analyses are not reused when a seed is given.
+    - keep_fraction: after each turn except the last, only this fraction of
+        the best actions is simulated further. simulation stops early when
+        the best action is clearly separated from the others, which needs
+        at least 2 sims_to_average (see versus.Advisor.top_is_separated).
+    - beam_width: how many swaps to continue from each state after the
+        first action of a turn. this keeps turns with several extra actions
+        affordable. None (default) for no limit.
+    - keep_going: optional callable checked while simulating. simulation
+        stops when it returns False, e.g. when the analysis is stale, and
+        the results of the completed turns are returned.
+    - expected_refill: score the refill right after each action by its
+        expected cascades instead of sampling them (see versus.Advisor)
     """
+    global _versus_advisor
     board, player, opponent, extra_actions = _state_investigator.get_versus()
-    if extra_actions: extra_actions = 1  # limit value for realistic time
     if board is None:
         return tuple()
-    averaged_summaries = list()  # default return value is empty
-    # keep a separate advisor for each simulation to average
-    advisors = list()
-    for i in range(sims_to_average):
-        advisor = versus.Advisor()
-        advisor.reset(board, player, opponent, extra_actions)
-        advisors.append(advisor)
+    # run all simulations to average in one tree so that any states they
+    # agree on are only simulated once. the advisor averages the results
+    advisor = _versus_advisor
+    if (advisor is None or advisor.sims != sims_to_average
+            or advisor.beam_width != beam_width
+            or advisor.expected_refill != expected_refill
+            or seed is not None):
+        advisor = _versus_advisor = versus.Advisor(
+            seed, sims_to_average, expected_refill=expected_refill,
+            beam_width=beam_width)
+    advisor.advance(board, player, opponent, extra_actions)
+    sent = dict()  # last values placed on the queue for each action
+    averaged_summaries = advisor.sorted_current_summaries()
+    if not async_results_q is None:
+        _put_summary_deltas(async_results_q, averaged_summaries, sent)
     # provide async sim results per turn; final results as return value
-    for turn in range(turns):
-        # store    {action: list of results from each simulation}
-        summaries_by_action = dict()
-        for i in range(sims_to_average):
-            advisor = advisors[i]
-            advisor.simulate_next_turn()
-            for s in advisor.sorted_current_summaries():
-                summaries_by_action.setdefault(s.action, list()).append(s)
-        # now all sims and analysis for this turn have been completed
-        averaged_summaries = list()
-        for action, summaries in summaries_by_action.items():
-            board = summaries[0].board  # any board. they are all the same
-            action = summaries[0].action  # any action. they are all the same
-            score_sum = sum(s.score for s in summaries)
-            score_avg = score_sum / len(summaries)
-            manadrain_sum = sum(s.mana_drain_leaves for s in summaries)
-            leaves_sum = sum(s.total_leaves for s in summaries)
-            avg_summary = base.Summary(board, action, score_avg,
-                                       manadrain_sum, leaves_sum)
-            averaged_summaries.append(avg_summary)
-        averaged_summaries.sort(key=lambda s: s.score, reverse=True)
+    for turn in range(advisor.current_completed_turn, turns):
+        if not advisor.simulate_next_turn(keep_going):
+            break
+        averaged_summaries = advisor.sorted_current_summaries()
         # option to provide the results asynchronouslys
         if not async_results_q is None:
-            async_results_q.put(averaged_summaries)
+            _put_summary_deltas(async_results_q, averaged_summaries, sent)
+        # spend the remaining turns on the best actions only
+        if turn + 1 < turns:
+            if advisor.top_is_separated():
+                break
+            advisor.drop_hopeless(keep_fraction)
     return averaged_summaries
 
 
+def versus_summaries_sequential(turns=2, batch_sims=2, max_sims=16, top_k=1,
+                                async_results_q=None, seed=None,
+                                beam_width=None):
+    """Return summaries of each available action averaged over as many
+    sims as needed to rank the top_k actions with confidence.
+
+    Arguments:
+    - batch_sims: sims added at a time
+    - max_sims: the most sims to run in total
+    - top_k: how many of the best actions should be confidently ranked
+    - turns, async_results_q, seed, beam_width: same as versus_summaries
+    """
+    board, player, opponent, extra_actions = _state_investigator.get_versus()
+    if board is None:
+        return tuple()
+    batch_summaries = None
+    if not async_results_q is None:
+        sent = dict()  # last values placed on the queue for each action
+        batch_summaries = lambda summaries: \
+            _put_summary_deltas(async_results_q, summaries, sent)
+    return versus.sequential_summaries(board, player, opponent,
+                                       extra_actions, turns, batch_sims,
+                                       max_sims, top_k, seed=seed,
+                                       batch_summaries=batch_summaries,
+                                       beam_width=beam_width)
+
+
+def versus_signature():
+    """Return a cheap signature of the on-screen versus game that changes
+    when the game changes. see base.ChangeWatcher"""
+    return _state_investigator.game_signature('versus')
+
+
+def versus_watcher(changes_q, period=0.25, max_period=4.0):
+    """Watch the on-screen versus game and put True on changes_q each time
+    it has changed and settled. Runs until the process is terminated.
+
+    This is intended for its own process since finding a game that has
+    moved or is not on screen can take seconds.
+
+    Arguments:
+    - period: seconds between checks of the game
+    - max_period: while no game is found, the time between checks doubles
+        up to this many seconds so an idle watcher doesn't keep searching
+        the screen
+    """
+    watcher = base.ChangeWatcher()
+    delay = period
+    while True:
+        signature = versus_signature()
+        if watcher.settled_change(signature):
+            changes_q.put(True)
+        if signature is None:
+            delay = min(delay * 2, max(period, max_period))
+        else:
+            delay = period
+        time.sleep(delay)
+
+
+def apply_summary_deltas(summaries, delta):
+    """Return sorted summaries updated with one delta from versus_summaries.
+
+    Each delta is (board string or None, changes) where changes has
+    (action, rank, score, mana drain leaves, total leaves, score variance,
+    score interval) for each action that changed. The rank is the position
+    in the sorted summaries. The board string is only in the first delta
+    of an analysis so the board is not sent again for every summary.
+
+    Arguments:
+    - summaries: the summaries from the previous deltas of the analysis
+        or an empty sequence for the first one.
+    """
+    board_string, changes = delta
+    if board_string is None:
+        board = summaries[0].board
+    else:
+        board = base.Board(board_string)
+    ranked = dict((summary.action, (rank, summary))
+                  for rank, summary in enumerate(summaries))
+    for change in changes:
+        action, rank, values = change[0], change[1], change[2:]
+        ranked[action] = rank, base.Summary(board, action, *values)
+    return [summary for rank, summary in sorted(ranked.values())]
+
+
+def _put_summary_deltas(q, summaries, sent):
+    """Put the changes since the last delta on q if there are any.
+
+    Arguments:
+    - sent: dict of action: values already sent. Updated in place.
+    """
+    board_string = None
+    if summaries and not sent:
+        board_string = str(summaries[0].board)
+    changes = list()
+    for rank, summary in enumerate(summaries):
+        values = (summary.action, rank, summary.score,
+                  summary.mana_drain_leaves, summary.total_leaves,
+                  summary.score_variance, summary.score_interval)
+        if sent.get(summary.action) != values:
+            sent[summary.action] = values
+            changes.append(values)
+    if changes:
+        q.put((board_string, tuple(changes)))
+
+
+def versus_worker(requests_q, async_results_q, turns=2, sims_to_average=2,
+                  ponder_turns=1, beam_width=None):
+    """Analyze the on-screen versus game for each request and keep
+    simulating (pondering) in between.
+
+    Arguments:
+    - requests_q: a multiprocessing Queue of request ids. None stops the
+        worker.
+    - async_results_q: a multiprocessing Queue on which (request id,
+        delta) is placed for each turn of an analysis and then
+        (request id, None) when the analysis is done. see
+        apply_summary_deltas for the delta format.
+    - turns, sims_to_average, beam_width: same as versus_summaries
+    - ponder_turns: how many turns to simulate beyond the analysis while
+        the opponent moves. pondering stops as soon as a request arrives.
+
+    An analysis also stops as soon as a newer request arrives since its
+    results would only be thrown away.
+    """
+    request_id = requests_q.get()
+    while request_id is not None:
+        results_q = _TaggedQueue(async_results_q, request_id)
+        versus_summaries(turns, sims_to_average, results_q,
+                         beam_width=beam_width, keep_going=requests_q.empty)
+        results_q.put(None)
+        if _versus_advisor is not None:
+            _versus_advisor.ponder(turns + ponder_turns, requests_q.empty)
+        request_id = requests_q.get()
+
+
+class _TaggedQueue(object):
+    """Put each item on a queue together with a tag."""
+    def __init__(self, q, tag):
+        self._q = q
+        self._tag = tag
+
+    def put(self, item):
+        self._q.put((self._tag, item))
+
+
 def capture_solution():
     board = _state_investigator.get_capture()
     if board is None:
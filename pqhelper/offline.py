@@ -0,0 +1,205 @@
+"""Analyze saved screenshots instead of the game on screen."""
+from itertools import imap
+import json
+import multiprocessing as mp
+import os
+from os import path
+import time
+
+from investigators.visuals import cv2
+
+from pqhelper import base, capture, versus
+
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpg', '.jpeg', '.png')
+
+
+def analyze_files(paths, game_type='versus', solve=False, processes=None,
+                  results_file=None, turns=2, sims_to_average=2,
+                  beam_width=None, seed=None):
+    """Analyze every screenshot in paths and generate one result dict for
+    each in the order of the files.
+
+    Arguments:
+    - paths: image files and directories. directories are searched
+        recursively for files with IMAGE_EXTENSIONS.
+    - game_type: 'capture' or 'versus'
+    - solve: also solve the capture or summarize the versus actions
+    - processes: how many processes share the screenshots. default is the
+        number of cpus. 1 analyzes everything in this process.
+    - results_file: optional file on which each result is written as a
+        JSON line as soon as it is ready
+    - turns, sims_to_average, beam_width: same as easy.versus_summaries
+        when solving
+    - seed: optional seed to reproduce the random fills of the versus
+        simulations. every file is simulated with the same seed so each
+        result is reproducible on its own.
+    """
+    jobs = ((image_path, game_type, solve, turns, sims_to_average, beam_width,
+             seed)
+            for image_path in image_paths(paths))
+    pool = None
+    if processes == 1:
+        results = imap(_analyze_file, jobs)
+    else:
+        pool = mp.Pool(processes)
+        results = pool.imap(_analyze_file, jobs)
+    try:
+        for result in results:
+            if results_file is not None:
+                results_file.write(json.dumps(result, sort_keys=True) + '\n')
+                results_file.flush()
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def image_paths(paths):
+    """Generate every image file in paths in sorted order."""
+    for file_or_directory in paths:
+        if not path.isdir(file_or_directory):
+            yield file_or_directory
+            continue
+        for directory, subdirectories, files in os.walk(file_or_directory):
+            subdirectories.sort()  # walk in order
+            for name in sorted(files):
+                if path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield path.join(directory, name)
+
+
+def _analyze_file(job):
+    """Return the result dict for one screenshot. Errors are recorded in
+    the result so that one bad file does not stop a batch."""
+    image_path, game_type, solve, turns, sims_to_average, beam_width, seed = \
+        job
+    investigator = _fresh_investigator(game_type)
+    result = {'path': image_path, 'game_type': game_type}
+    start = time.time()
+    try:
+        screen_image = cv2.imread(image_path)
+        if screen_image is None:
+            raise IOError('Unable to read the image.')
+        if game_type == 'capture':
+            result.update(_capture_result(investigator, screen_image,
+                                          solve))
+        else:
+            result.update(_versus_result(investigator, screen_image, solve,
+                                         turns, sims_to_average,
+                                         beam_width, seed))
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def _fresh_investigator(game_type):
+    """Return an investigator that remembers nothing about earlier files
+    (e.g. game location, last board) so each result depends only on its
+    own file. The tools shared by all investigators are loaded first so
+    that loading them is not timed with the first file."""
+    investigator = base.StateInvestigator()
+    investigator._game_finders[game_type]
+    investigator._board_tools
+    investigator._bonus_tools
+    investigator._actor_tools
+    return investigator
+
+
+def _capture_result(investigator, screen_image, solve):
+    board = investigator.get_capture(screen_image)
+    result = {'board': _board_dict(board),
+              'tile_match_values': _tile_rows(investigator)}
+    if solve and board is not None:
+        steps = capture.capture(board)
+        result['solution'] = [_action_list(step.action) for step in steps]
+    return result
+
+
+def _versus_result(investigator, screen_image, solve, turns,
+                   sims_to_average, beam_width, seed):
+    board, player, opponent, extra_actions = \
+        investigator.get_versus(screen_image)
+    result = {'board': _board_dict(board),
+              'tile_match_values': _tile_rows(investigator),
+              'player': _actor_dict(player),
+              'opponent': _actor_dict(opponent),
+              'extra_actions': extra_actions}
+    parts = board, player, opponent
+    if solve and all(part is not None for part in parts):
+        advisor = versus.Advisor(seed, sims_to_average,
+                                 beam_width=beam_width)
+        advisor.reset(board, player, opponent, extra_actions)
+        for turn in range(turns):
+            advisor.simulate_next_turn()
+        result['summaries'] = [_summary_dict(summary) for summary
+                               in advisor.sorted_current_summaries()]
+    return result
+
+
+def _board_dict(board):
+    return None if board is None else str(board)
+
+
+def _tile_rows(investigator):
+    """Return the match value of each tile of the last board as rows or
+    None if there is no board."""
+    match_values = investigator.tile_match_values
+    if match_values is None:
+        return None
+    rows = sorted(set(row for row, column in match_values))
+    columns = sorted(set(column for row, column in match_values))
+    return [[match_values[row, column] for column in columns]
+            for row in rows]
+
+
+def _actor_dict(actor):
+    """Return {stat: [value, max]} for the actor or None."""
+    if actor is None:
+        return None
+    return dict((stat, [getattr(actor, stat), getattr(actor, stat + '_max')])
+                for stat in base._ACTOR_STATS)
+
+
+def _action_list(action):
+    return [list(position) for position in action]
+
+
+def _summary_dict(summary):
+    interval = summary.score_interval
+    return {'action': _action_list(summary.action),
+            'score': float(summary.score),
+            'mana_drain_leaves': summary.mana_drain_leaves,
+            'total_leaves': summary.total_leaves,
+            'score_variance': summary.score_variance,
+            'score_interval': None if interval is None
+            else [float(bound) for bound in interval]}
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description=
+                                     'Analyze saved PQ screenshots and write'
+                                     ' one JSON line for each.')
+    parser.add_argument('game_type', choices=('capture', 'versus'))
+    parser.add_argument('paths', nargs='+', help='image files or directories')
+    parser.add_argument('--solve', action='store_true')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--turns', type=int, default=2,
+                        help='versus turns to simulate when solving')
+    parser.add_argument('--sims', type=int, default=2,
+                        help='versus simulations to average when solving')
+    parser.add_argument('--beam-width', type=int, default=None,
+                        help='versus swaps continued after the first action'
+                             ' of a turn')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed to reproduce the versus random fills')
+    arguments = parser.parse_args()
+    for _ in analyze_files(arguments.paths, arguments.game_type,
+                           arguments.solve, arguments.processes,
+                           results_file=sys.stdout, turns=arguments.turns,
+                           sims_to_average=arguments.sims,
+                           beam_width=arguments.beam_width,
+                           seed=arguments.seed):
+        pass
@@ -10,6 +10,8 @@ import ttk
 import Image as PIL_Image
 import numpy
 
+from investigators.visuals import cv2
+
 from pqhelper import easy, data, base
 _this_path = path.abspath(path.split(__file__)[0])
 
@@ -29,7 +31,8 @@ class GUI(object):
         # setup versus
         versus_tab = ttk.Frame(notebook)
         notebook.add(versus_tab, text='Versus')
-        _GenericGameGUI(versus_tab, easy.versus_summaries, time_limit=10.0)
+        _PonderingGameGUI(versus_tab, easy.versus_worker, time_limit=10.0,
+                          watch_function=easy.versus_watcher)
         # setup capture
         capture_tab = ttk.Frame(notebook)
         notebook.add(capture_tab, text='Capture')
@@ -70,10 +73,10 @@ class _GenericGameGUI(object):
 
     def _create_tile_images(self):
         images = dict()
-        for character, image in data.tile_templates.items():
+        for character, image in data.tile_templates().items():
             tile_size = self._TILE_SHAPE[0:2]
-            resized = data.cv2.resize(image, tile_size,
-                                      interpolation=data.cv2.INTER_AREA)
+            resized = cv2.resize(image, tile_size,
+                                 interpolation=cv2.INTER_AREA)
             images[character] = resized
         return images
 
@@ -101,6 +104,7 @@ class _GenericGameGUI(object):
         next_button.pack(side=tk.RIGHT)
         prev_button = tk.Button(second_row, text='-', command=self._previous)
         prev_button.pack(side=tk.RIGHT)
+        parts['button row'] = second_row
         # third row: notification messages
         third_row = tk.Frame(base)
         third_row.pack(anchor=tk.N, expand=1, fill=tk.X)
@@ -140,13 +144,13 @@ class _GenericGameGUI(object):
         r = tile_w * (1 + max(col_1, col_2))
         top_left = (l, t)
         bottom_right = (r, b)
-        data.cv2.rectangle(board_image, top_left, bottom_right,
-                           color=(255, 255, 255), thickness = 4)
+        cv2.rectangle(board_image, top_left, bottom_right,
+                      color=(255, 255, 255), thickness = 4)
 
     def _convert_cv_to_tk(self, image_cv):
         """Convert an OpenCV image to a tkinter PhotoImage"""
         # convert BGR to RGB
-        image_cv_rgb = data.cv2.cvtColor(image_cv, data.cv2.COLOR_BGR2RGB)
+        image_cv_rgb = cv2.cvtColor(image_cv, cv2.COLOR_BGR2RGB)
         # convert opencv to PIL
         image_pil = PIL_Image.fromarray(image_cv_rgb)
         # convert PIL to tkinter
@@ -202,19 +206,22 @@ class _GenericGameGUI(object):
                 last_result = self._analysis_process.out_q.get(timeout=0.001)
             except QEmpty:
                 break  # nothing left on the queue
-        self.summaries = last_result
-        if last_result:
+        self._present_results(last_result, success_message, failure_message)
+        try:
+            self._analysis_process.terminate()
+        except AttributeError:
+            pass  # just no process. ignore it.
+        self._analysis_process = None
+
+    def _present_results(self, results, success_message, failure_message):
+        self.summaries = results
+        if results:
             self._clear_ui()
             self._update_summary(self.summaries[0])
             self._update_notification(success_message)
         else:
             self._clear_ui()
             self._update_notification(failure_message)
-        try:
-            self._analysis_process.terminate()
-        except AttributeError:
-            pass  # just no process. ignore it.
-        self._analysis_process = None
 
     def _next(self):
         """Get the next summary and present it."""
@@ -254,6 +261,9 @@ class _GenericGameGUI(object):
             text = ''
             if not summary.score is None:
                 text += 'Score: {:3.1f}'.format(summary.score)
+            if not summary.score_interval is None:
+                low, high = summary.score_interval
+                text += ' (+/- {:3.1f})'.format((high - low) / 2)
             if (not summary.mana_drain_leaves is None) and\
                     (not summary.total_leaves is None):
                 text += '       Mana Drains: {}/{}' \
@@ -273,5 +283,138 @@ class _GenericGameGUI(object):
         self._base.update()
 
 
+class _PonderingGameGUI(_GenericGameGUI):
+    """Game GUI with one long running worker process that keeps simulating
+    between analyses instead of a new process for each analysis."""
+    def __init__(self, base, worker_function, time_limit=5.0,
+                 watch_function=None, watch_period=0.25):
+        """Arguments:
+        - worker_function: called in the worker process with a requests
+            queue and a results queue. see easy.versus_worker
+        - watch_function: optional function called in a watcher process
+            with a changes queue and watch_period. see easy.versus_watcher. this adds a
+            watch mode that analyzes each time the game changes and settles
+        - watch_period: seconds between checks for changes
+        """
+        super(_PonderingGameGUI, self).__init__(base, worker_function,
+                                                time_limit)
+        self._requests_q = mp.Queue()
+        self._results_q = mp.Queue()
+        self._worker = None
+        self._request_id = 0
+        self._last_result = None
+        # watch mode
+        self._watch_function = watch_function
+        self._watch_period = watch_period
+        self._watch_period_milliseconds = int(round(watch_period * 1000))
+        self._watcher = None
+        self._changes_q = None
+        self._watch_id = 0
+        self._watching = tk.IntVar()
+        if watch_function is not None:
+            watch_button = tk.Checkbutton(self._parts['button row'],
+                                          text='Watch',
+                                          variable=self._watching,
+                                          command=self._toggle_watch)
+            watch_button.pack(side=tk.LEFT)
+
+    def _toggle_watch(self):
+        """Start or stop watching the game on screen for changes. The
+        screen is watched in its own process so the GUI stays responsive
+        even when finding the game takes a while."""
+        self._watch_id += 1  # stop any previous watch loop
+        if self._watcher is not None:
+            self._watcher.terminate()
+            self._watcher = None
+        if self._watching.get():
+            # a new queue since terminating can leave the old one broken
+            self._changes_q = mp.Queue()
+            self._watcher = mp.Process(target=self._watch_function,
+                                       args=(self._changes_q,
+                                             self._watch_period))
+            self._watcher.daemon = True  # don't outlive the GUI
+            self._watcher.start()
+            self._scheduled_watch(self._watch_id)
+
+    def _scheduled_watch(self, watch_id):
+        """Analyze when the watcher reports that the game on screen has
+        changed and settled."""
+        if watch_id != self._watch_id:
+            return  # watching was stopped or restarted
+        changed = False
+        while True:
+            try:
+                changed = self._changes_q.get(timeout=0.001)
+            except QEmpty:
+                break
+        if changed:
+            self._analyze()  # replaces any stale analysis
+        self._base.after(self._watch_period_milliseconds,
+                         self._scheduled_watch, watch_id)
+
+    def _analyze(self):
+        """Ask the worker to analyze the game on screen."""
+        self._analyze_start_time = time.time()
+        self._clear_ui()
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = mp.Process(target=self._analysis_function,
+                                      args=(self._requests_q,
+                                            self._results_q))
+            self._worker.daemon = True  # don't outlive the GUI
+            self._worker.start()
+        self._request_id += 1
+        self._last_result = None
+        self._requests_q.put(self._request_id)
+        self._base.after(self._POLL_PERIOD_MILLISECONDS,
+                         self._scheduled_check_for_worker_results,
+                         self._request_id)
+        self._update_notification('Analyzing the on-screen game.')
+
+    def _scheduled_check_for_worker_results(self, request_id):
+        """Present the results each time they change until they are
+        complete or timed out. The worker is left running either way."""
+        if request_id != self._request_id:
+            return  # a newer analysis has replaced this one
+        done, changed = self._collect_worker_results()
+        if changed and not done:
+            self._present_results(self._last_result,
+                                  'Analyzing the on-screen game.\n'
+                                  ' Showing the results so far.',
+                                  'Analyzing the on-screen game.')
+        if done:
+            self._present_results(self._last_result, 'Completed analysis.',
+                                  'Unable to find the game on screen.')
+            return
+        timed_out = time.time() - self._analyze_start_time > self.time_limit
+        if timed_out:
+            self._present_results(self._last_result,
+                                  'Analysis timed out but managed\n'
+                                  ' to get lower turn results.',
+                                  'Analysis timed out with no results.')
+            return
+        self._base.after(self._POLL_PERIOD_MILLISECONDS,
+                         self._scheduled_check_for_worker_results,
+                         request_id)
+
+    def _collect_worker_results(self):
+        """Keep the latest results of the current request. Return (done,
+        changed) where done is True when the worker has finished the
+        current request and changed is True when the results changed."""
+        done = changed = False
+        while True:
+            try:
+                request_id, results = self._results_q.get(timeout=0.001)
+            except QEmpty:
+                return done, changed
+            if request_id != self._request_id:
+                continue  # left over from an earlier request
+            if results is None:
+                done = True
+            else:
+                self._last_result = easy.apply_summary_deltas(
+                    self._last_result or (), results)
+                changed = True
+
+
 if __name__ == "__main__":
     GUI()
@@ -1,11 +1,45 @@
+import numpy
+
 from pqhelper import base
 
 
+# value of each actor attribute when scoring the end of a simulation.
+# simple prioritization without regard to character attributes
+DEFAULT_WEIGHTS = {'health': 2,
+                   'r': 1, 'g': 1, 'b': 1, 'y': 1,
+                   'x': 0.5, 'm': 0.5}
+# standard errors on each side of a score for its confidence interval (95%)
+INTERVAL_Z = 1.96
+# fewest sims of an action before it can be ranked with confidence
+RANKING_MIN_SIMS = 2
+# balance added for defeating the opponent (subtracted when defeated).
+# large enough to outweigh any difference in attributes
+DECISIVE_BALANCE = 100000
+
+
 class Advisor(object):
-    def __init__(self):
+    def __init__(self, seed=None, sims=1, weights=None,
+                 expected_refill=False, beam_width=None):
+        """Arguments:
+        seed: optional seed to reproduce the random fills of the simulation
+        sims: number of random fill simulations to average in one tree
+        weights: optional dict of actor attribute: value used for scoring
+            instead of DEFAULT_WEIGHTS. missing attributes are worth zero.
+        expected_refill: score the refill right after each root action by
+            its expected cascades instead of sampling it (see base.Game)
+        beam_width: optional limit of the swaps continued from each state
+            after the first action of a turn (see base.Game)
+        """
         self._current_completed_turn = 0
         self._root = None
-        self._game = base.Game(True)
+        self._contenders = None  # root actions still simulated. None is all
+        self._game = base.Game(True, seed, sims, expected_refill)
+        self._game.beam_width = beam_width
+        self._sims = sims
+        weights = weights or DEFAULT_WEIGHTS
+        self._weights = numpy.array([weights.get(stat, 0)
+                                     for stat in base._ACTOR_STATS],
+                                    dtype=float)
 
     @property
     def current_completed_turn(self):
@@ -15,120 +49,563 @@ class Advisor(object):
         total_actions = 1 + extra_actions
         self._root = base.State(board, player, opponent,
                                 1, total_actions)
+        self._contenders = None
         self._current_completed_turn = 0
 
-    def simulate_next_turn(self):
-        eots = list(self._game.ends_of_next_whole_turn(self._root))
+    @property
+    def sims(self):
+        return self._sims
+
+    @property
+    def beam_width(self):
+        return self._game.beam_width
+
+    @property
+    def expected_refill(self):
+        return self._game.expected_refill
+
+    def advance(self, board, player, opponent, extra_actions):
+        """Continue from the simulated state that matches the new situation
+        and keep everything already simulated below it. Reset if there is no
+        matching state.
+
+        Return True if a simulated state was reused and False otherwise.
+        """
+        total_actions = 1 + extra_actions
+        match = self._matching_state(board, player, opponent, total_actions)
+        if match is None:
+            self.reset(board, player, opponent, extra_actions)
+            return False
+        self._promote(match)
+        return True
+
+    def _matching_state(self, board, player, opponent, actions_remaining):
+        """Return a state ready for the player's action with the same board,
+        actors and actions remaining or None if there is none."""
+        if self._root is None:
+            return None
+        for node in self._root.post_order_nodes():
+            if not isinstance(node, base.State):
+                continue
+            # only the player's turn and not in the middle of a chain
+            if not node.turn % 2:
+                continue
+            if node.actions_remaining != actions_remaining:
+                continue
+            if any(isinstance(child, (base.ChainReaction,
+                                      base.Transposition))
+                   for child in node.children):
+                continue
+            if (node.board == board and node.player == player
+                    and node.opponent == opponent):
+                return node
+        return None
+
+    def _promote(self, state):
+        """Make state the new root and drop the rest of the old tree."""
+        # the root must have no parent so replace it with a new state and
+        # move the subtrees to it. storage is also moved to a new arena so
+        # the rest of the old tree can be released
+        arena = base.StateArena(state.player, state.opponent)
+        root = base.State(state.board, state.player, state.opponent,
+                          state.turn, state.actions_remaining, arena)
+        for child in list(state.children):
+            root.graft_child(child)
+        self._adopt_transposed_originals(root)
+        for node in root.post_order_nodes():
+            if isinstance(node, base.State) and node is not root:
+                node.move_to(arena)
+        self._share_missing_sims(root, state.sims)
+        # the root actions of the same root keep their different depths so
+        # only the contenders continue. any other state is below a single
+        # root action and its actions were all simulated equally
+        if state is not self._root:
+            self._contenders = None
+        self._root = root
+        # completed turns are counted from the new root
+        ends = [leaf.parent.turn for leaf in root.leaves()
+                if isinstance(leaf, base.EOT)]
+        if ends:
+            self._current_completed_turn = max(ends) - root.turn + 1
+        else:
+            self._current_completed_turn = 0
+
+    def _share_missing_sims(self, root, sims):
+        """Extend the simulated subtree of root to the sims that did not
+        reach the promoted state so that every sim continues from root.
+
+        Each missing sim follows the random fills of one of the sims that
+        did reach it for everything already simulated. Its own random fills
+        are used for everything simulated from now on.
+
+        Arguments:
+        sims: the sims of the promoted state
+        """
+        game = self._game
+        present = game._sim_ids(sims)
+        missing = [sim_id for sim_id in game._sim_ids(0)
+                   if sim_id not in present]
+        if not missing:
+            return
+        # bits of the missing sims that follow each present sim
+        followers = dict()
+        for i, sim_id in enumerate(missing):
+            leader = present[i % len(present)]
+            followers[leader] = followers.get(leader, 0) | 1 << sim_id
+        for node in root.post_order_nodes():
+            if isinstance(node, base.State) and node is not root:
+                node_sims = node.sims
+                for leader, bits in followers.items():
+                    if node_sims & 1 << leader:
+                        node_sims |= bits
+                node.sims = node_sims
+        # chances are the portion of the sims of the state they split
+        for node in root.post_order_nodes():
+            if isinstance(node, base.Chance):
+                result_state = node.children[0]
+                source_state = node.parent.parent
+                node.weight = (float(len(game._sim_ids(result_state.sims)))
+                               / len(game._sim_ids(source_state.sims)))
+
+    def _adopt_transposed_originals(self, root):
+        """Replace each transposition below root to an original outside of
+        root with the subtree of the original so that the tree of root is
+        complete without the rest of the old tree.
+
+        The emptied original gets a transposition to the state that adopted
+        its subtree in case it is itself reached from root.
+        """
+        inside = set(id(node) for node in root.post_order_nodes())
+        pending = [node for node in root.post_order_nodes()
+                   if isinstance(node, base.Transposition)]
+        while pending:
+            transposition = pending.pop()
+            original = transposition.state
+            # follow originals that already gave away their subtree
+            while (id(original) not in inside
+                   and len(original.children) == 1
+                   and isinstance(original.children[0],
+                                  base.Transposition)):
+                original = original.children[0].state
+            transposition.state = original
+            if id(original) in inside:
+                continue
+            adopter = transposition.parent
+            transposition.prune()
+            moved = list(original.children)
+            for child in moved:
+                adopter.graft_child(child)
+            original.graft_child(base.Transposition(adopter))
+            for child in moved:
+                for node in child.post_order_nodes():
+                    inside.add(id(node))
+                    if isinstance(node, base.Transposition):
+                        pending.append(node)
+
+    def simulate_next_turn(self, keep_going=None):
+        """Simulate the next turn of the remaining contenders. Return True
+        if the turn was completed.
+
+        Arguments:
+        keep_going: optional callable checked before each simulated state.
+            When it returns False, the partially simulated turn is
+            discarded and False is returned.
+        """
+        if keep_going is not None:
+            keep_going = _Interruption(keep_going)
+        # remember where the turn starts in case it has to be discarded
+        starts = [leaf for leaf in self._root.leaves()
+                  if leaf is self._root or isinstance(leaf, base.EOT)]
+        eots = list(self._game.ends_of_next_whole_turn(
+            self._root, self._contenders, keep_going=keep_going))
+        if keep_going is not None and keep_going.interrupted:
+            for start in starts:
+                for child in list(start.children):
+                    self._discard(child)
+            return False
         if eots:
             self._current_completed_turn += 1
+            self._reward_choices()
+        return True
+
+    def _discard(self, node):
+        """Prune node and release the arena rows of the states below it so
+        that later states can reuse them."""
+        node.prune()
+        node_ids_by_arena = dict()
+        for state in node.post_order_nodes():
+            if isinstance(state, base.State):
+                node_ids_by_arena.setdefault(state.arena,
+                                             list()).append(state.node_id)
+        for arena, node_ids in node_ids_by_arena.items():
+            arena.release(node_ids)
+
+    def _reward_choices(self):
+        """Reward the swap chosen at each state in the swap ordering so
+        that later turns expand the likely best swaps first."""
+        balances = self._leaf_balances(self._root)
+        chosen = list()
+        for action in self._root_actions():
+            self._expected_balance(action, balances, chosen)
+        for swap in chosen:
+            self._game.ordering.reward(swap.position_pair,
+                                       turn=swap.parent.turn)
+
+    def drop_hopeless(self, keep_fraction=0.5):
+        """Stop simulating all but the best keep_fraction of the root actions
+        that are still simulated (at least one is kept).
+
+        Dropped actions are still summarized but are sorted after the
+        remaining contenders since they have been simulated less.
+        """
+        contenders = self._sorted_contender_scores()
+        keep_count = max(1, int(round(len(contenders) * keep_fraction)))
+        self._contenders = [action for score, sim_scores, action
+                            in contenders[:keep_count]]
+
+    def top_is_separated(self, z=INTERVAL_Z, min_sims=RANKING_MIN_SIMS):
+        """Return True if the confidence interval of the best root action
+        is above the interval of the second best (see _top_is_ranked)."""
+        contenders = self._sorted_contender_scores()
+        if not contenders:
+            return False
+        return _top_is_ranked([(score, sim_scores)
+                               for score, sim_scores, action in contenders],
+                              1, z, min_sims)
+
+    def _sorted_contender_scores(self):
+        """Return (score, per sim scores, action) of each contender sorted
+        from best to worst."""
+        if self._root is None:
+            return list()
+        balances = self._leaf_balances(self._root)
+        scores = [self._action_scores(action, balances) + (action,)
+                  for action in self._root_actions()
+                  if self._is_contender(action)]
+        scores.sort(key=lambda score: score[0], reverse=True)
+        return scores
+
+    def _is_contender(self, action):
+        if self._contenders is None:
+            return True
+        return any(action is contender for contender in self._contenders)
+
+    def ponder(self, turns, keep_going=None):
+        """Continue simulating until turns are completed. This is intended
+        for the opponent's turn so that the next advance can reuse the
+        simulated replies to the player's action.
+
+        Arguments:
+        turns: total completed turns at which to stop
+        keep_going: optional callable checked before each simulated state.
+            Pondering stops as soon as it returns False and the turn in
+            progress is discarded.
+        """
+        while (self._root is not None
+               and self._current_completed_turn < turns):
+            completed_turn = self._current_completed_turn
+            if not self.simulate_next_turn(keep_going):
+                return  # interrupted
+            if self._current_completed_turn == completed_turn:
+                return  # nothing left to simulate
 
     def sorted_current_summaries(self):
         # return empty sequence for empty root
         try:
-            actions = tuple(self._root.children)
+            actions = self._root_actions()
         except AttributeError:
             return tuple()
-        summaries = list()
+        balances = self._leaf_balances(self._root)
+        contenders, dropped = list(), list()
         for action in actions:
-            summary = self._summarize_action(action)
-            summaries.append(summary)
+            summary = self._summarize_action(action, balances)
+            if self._is_contender(action):
+                contenders.append(summary)
+            else:
+                dropped.append(summary)
         # sort to the benefit of player (descending overall score)
-        summaries.sort(key=lambda summary: summary.score, reverse=True)
-        return summaries
+        for summaries in (contenders, dropped):
+            summaries.sort(key=lambda summary: summary.score, reverse=True)
+        return contenders + dropped
 
-    def _summarize_action(self, root_action):
-        """Return a dictionary with various information about this root_action.
+    def _summarize_action(self, root_action, balances):
+        """Return a summary with various information about this root_action.
 
         Note:
         Scoring assumes that each actor makes the "best" choices in their turn
-        based on the simulation available.
+        based on the simulation available. Random outcomes (Chance) are
+        averaged by the portion of sims that reached them.
         """
-        def is_target_node(node):
-            return isinstance(node, base.EOT) or (node is root_action)
-        # store per-turn results from the bottom up.
-        realistic_ends_by_node = dict()
-        for node in root_action.post_order_nodes():  # bottom up to this action
-            # only work with EOT or the root action
-            if not is_target_node(node):
-                continue
-            # by the time this node is reached, the results of all children
-            # have been stored under it in realistic_ends (except leaves)
-            # so choose the best of the available results and send it
-            # up to the next valid node
-            try:  # get the results stored previously in the deeper turn
-                realistic_ends = realistic_ends_by_node[node]
-            except KeyError:  # leaves are own realistic end
-                realistic_ends = [node]
-            # identify the "best" end for this node
-            if node is root_action:
-                active = node.parent.active
-                passive = node.parent.passive
+        score, sim_scores = self._action_scores(root_action, balances)
+        variance, interval = _score_spread(score, sim_scores)
+        return self._summarize_result(root_action, score, variance, interval)
+
+    def current_sim_scores(self):
+        """Return a dict of the score of each root action (by position pair)
+        in each sim that reached it."""
+        if self._root is None:
+            return dict()
+        balances = self._leaf_balances(self._root)
+        return dict((action.position_pair,
+                     self._action_scores(action, balances)[1])
+                    for action in self._root_actions())
+
+    def _root_actions(self):
+        """Return the swaps available at the root. There are none when the
+        game is already over."""
+        return tuple(child for child in self._root.children
+                     if isinstance(child, base.Swap))
+
+    def _action_scores(self, root_action, balances):
+        """Return the score of root_action and its score in each sim that
+        reached it."""
+        balance, sim_balances = self._expected_balance(root_action, balances)
+        start_state = root_action.parent
+        start_balance, = self._balances(start_state.arena,
+                                        [start_state.node_id])
+        change = -start_balance
+        # add the estimated cascades that were left out of the simulation
+        expected_refill = getattr(root_action, 'expected_refill', None)
+        if expected_refill is not None:
+            gains, attack = expected_refill
+            health_weight = self._weights[0]
+            change += numpy.dot(gains, self._weights) + attack * health_weight
+        sim_balances = sim_balances[self._sim_mask(start_state.sims)]
+        return balance + change, sim_balances + change
+
+    def _expected_balance(self, node, balances, chosen=None):
+        """Return the expected balance at the end of the simulation below
+        node and the balance in each sim. The balance is the player's score
+        minus the opponent's score.
+
+        The balance of a sim is only meaningful for sims that reach node.
+        It follows the same choices as the expected balance.
+
+        Arguments:
+        balances: the balance of each EOT leaf by id from _leaf_balances
+        chosen: optional list to which the swap chosen at each state is
+            added
+        """
+        if isinstance(node, base.EOT):
+            next_turns = node.children
+            if not next_turns:
+                # end of the simulation
+                balance = balances[id(node)]
+                return balance, numpy.repeat(balance, self._sims)
+            return self._expected_balance(next_turns[0], balances,
+                                          chosen)
+        if isinstance(node, base.State):
+            # the active actor chooses the best result for itself
+            results = [(self._expected_balance(child, balances, chosen),
+                        child)
+                       for child in node.children
+                       if not isinstance(child, base.Filtered)]
+            choose = max if node.active is node.player else min
+            result, choice = choose(results, key=lambda result: result[0][0])
+            if chosen is not None and isinstance(choice, base.Swap):
+                chosen.append(choice)
+            return result
+        if isinstance(node, base.Chance):
+            return self._expected_balance(node.children[0], balances,
+                                          chosen)
+        if isinstance(node, base.Transposition):
+            return self._expected_balance(node.state, balances, chosen)
+        # other transitions have one result or are split by chance
+        expected = 0
+        sim_balances = numpy.zeros(self._sims)
+        for child in node.children:
+            weight = getattr(child, 'weight', 1)
+            balance, child_sim_balances = \
+                self._expected_balance(child, balances, chosen)
+            expected += weight * balance
+            if isinstance(child, base.Chance):
+                child_sims = self._sim_mask(child.children[0].sims)
+                sim_balances[child_sims] = child_sim_balances[child_sims]
             else:
-                active = node.parent.passive
-                passive = node.parent.active
-            ends_by_score = dict()
-            for realistic_end in realistic_ends:
-                # determine the relative score. i.e. if delta is positive
-                # then the end result is better for active than passive
-                relative_score = self._relative_score(node, realistic_end,
-                                                      active, passive)
-                ends_by_score[relative_score] = realistic_end
-            best_end = ends_by_score[max(ends_by_score.keys())]
-            # done after determining realistic result for root action
-            if node is root_action:
-                return self._summarize_result(root_action, best_end)
-            # not done: place best end on the parent EOT's list of possibilities
-            parent = node.parent
-            while parent:
-                if is_target_node(parent):
-                    break
-                parent = parent.parent  # keep moving up until target found
-            # at this point the parent is either root_action or another EOT
-            realistic_ends_by_node.setdefault(parent, list()).append(best_end)
-        pass  # the algorithm should never reach this point...
-
-    def _relative_score(self, start_eot, end_eot, active, passive):
-        """Return the balance of perception between the two nodes.
-        A positive score indicates the result is relatively better for active.
+                sim_balances = child_sim_balances
+        return expected, sim_balances
+
+    def _sim_mask(self, sims):
+        """Return a boolean array of the sims in the sims bit mask."""
+        if not sims:
+            return numpy.ones(self._sims, dtype=bool)
+        return ((sims >> numpy.arange(self._sims)) & 1).astype(bool)
+
+    def _leaf_balances(self, root):
+        """Return a dict of the balance of every EOT leaf below root by id.
+
+        The end states of all leaves are evaluated together for each arena
+        rather than one at a time.
         """
-        active_start = self._score_eot_for_actor(start_eot, active)
-        passive_start = self._score_eot_for_actor(start_eot, passive)
-        active_end = self._score_eot_for_actor(end_eot, active)
-        passive_end = self._score_eot_for_actor(end_eot, passive)
-        return (active_end - passive_end) - (active_start - passive_start)
-
-    def _score_eot_for_actor(self, eot, actor):
-        """Have the actor evaluate the end of turn for itself only."""
-        # currently just simple sum of own attributes
+        leaves_by_arena = dict()
+        for leaf in root.leaves():
+            if isinstance(leaf, base.EOT):
+                end_state = leaf.parent
+                leaves, node_ids = leaves_by_arena.setdefault(end_state.arena,
+                                                              ([], []))
+                leaves.append(id(leaf))
+                node_ids.append(end_state.node_id)
+        balances = dict()
+        for arena, (leaves, node_ids) in leaves_by_arena.items():
+            balances.update(zip(leaves, self._balances(arena, node_ids)))
+        return balances
+
+    def _balances(self, arena, node_ids):
+        """Return the player's score minus the opponent's score for each
+        state in arena."""
+        # currently just a weighted sum of own attributes
         # could be much more sophisticated in both analysis (e.g. formulas)
         # and breadth of items analyzed (e.g. require other actor, the board)
-        end_state = eot.parent
-        a = {'player': end_state.player,
-             'opponent': end_state.opponent}[actor.name]
-        # simple prioritization without regard to character attributes
-        health = a.health * 2
-        r, g, b, y = a.r, a.g, a.b, a.y
-        x, m = 0.5 * a.x, 0.5 * a.m
-        return sum((health, r, g, b, y, x, m))
-
-    def _summarize_result(self, root_action, leaf_eot):
+        stats = arena.stats(node_ids)
+        balances = numpy.dot(stats[:, 0] - stats[:, 1], self._weights)
+        # games that are over are decided regardless of attributes
+        health = base._ACTOR_STATS.index('health')
+        defeated = ((stats[:, :, health] <= 0)
+                    & (arena.maxima[:, health] > 0))
+        balances += DECISIVE_BALANCE * (1.0 * defeated[:, 1] - defeated[:, 0])
+        return balances.tolist()
+
+    def _summarize_result(self, root_action, score, variance=None,
+                          interval=None):
         """Return a dict with useful information that summarizes this action."""
         root_board = root_action.parent.board
         action_detail = root_action.position_pair
-        score = self._relative_score(root_action, leaf_eot,
-                                     root_action.parent.player,
-                                     root_action.parent.opponent)
         # mana drain info
         total_leaves = 0
         mana_drain_leaves = 0
-        for leaf in root_action.leaves():
+        for leaf in _end_leaves(root_action):
             total_leaves += 1
             if leaf.is_mana_drain:
                 mana_drain_leaves += 1
         summary = base.Summary(root_board, action_detail, score,
-                               mana_drain_leaves, total_leaves)
+                               mana_drain_leaves, total_leaves,
+                               variance, interval)
         return summary
 
 
+class _Interruption(object):
+    """Wrap a keep_going callable and remember when it returned False.
+    It is not called again after that."""
+    def __init__(self, keep_going):
+        self._keep_going = keep_going
+        self.interrupted = False
+
+    def __call__(self):
+        if not self.interrupted and not self._keep_going():
+            self.interrupted = True
+        return not self.interrupted
+
+
+def sequential_summaries(board, player, opponent, extra_actions, turns=2,
+                         batch_sims=2, max_sims=16, top_k=1, z=INTERVAL_Z,
+                         seed=None, batch_summaries=None, beam_width=None):
+    """Return summaries averaged over batches of sims. Batches are added
+    until the confidence intervals of the top_k actions no longer overlap
+    the next action or max_sims have been run.
+
+    Each batch is simulated in its own tree with its own random fills.
+
+    Arguments:
+    z: standard errors on each side of a score for its confidence interval
+    batch_summaries: optional callable that receives the summaries after
+        each batch
+    beam_width: see Advisor
+    """
+    seeds = iter(base.RandomFill(seed).spawn_seeds(max_sims))
+    sim_scores = dict()
+    leaf_counts = dict()
+    summaries = list()
+    sims_run = 0
+    while sims_run < max_sims:
+        sims = min(batch_sims, max_sims - sims_run)
+        advisor = Advisor(next(seeds), sims, beam_width=beam_width)
+        advisor.reset(board.copy(), player.copy(), opponent.copy(),
+                      extra_actions)
+        for turn in range(turns):
+            advisor.simulate_next_turn()
+        sims_run += sims
+        for action, scores in advisor.current_sim_scores().items():
+            sim_scores.setdefault(action, list()).extend(scores)
+        for summary in advisor.sorted_current_summaries():
+            counts = leaf_counts.setdefault(summary.action, [0, 0])
+            counts[0] += summary.mana_drain_leaves
+            counts[1] += summary.total_leaves
+        summaries = list()
+        for action, scores in sim_scores.items():
+            score = numpy.mean(scores)
+            variance, interval = _score_spread(score, scores, z)
+            mana_drain_leaves, total_leaves = leaf_counts[action]
+            summaries.append(base.Summary(board, action, score,
+                                          mana_drain_leaves, total_leaves,
+                                          variance, interval))
+        summaries.sort(key=lambda summary: summary.score, reverse=True)
+        if batch_summaries is not None:
+            batch_summaries(summaries)
+        if _top_is_ranked([(summary.score, sim_scores[summary.action])
+                           for summary in summaries], top_k, z):
+            break
+    return summaries
+
+
+def _end_leaves(node):
+    """Return each EOT leaf reached from node once. The leaves of the
+    original of a transposition are reached in place of the transposition."""
+    leaves = dict()
+    expanded = set()
+    pending = [node]
+    while pending:
+        start = pending.pop()
+        if id(start) in expanded:
+            continue
+        expanded.add(id(start))
+        for leaf in start.leaves():
+            if isinstance(leaf, base.EOT):
+                leaves[id(leaf)] = leaf
+            elif isinstance(leaf, base.Transposition):
+                pending.append(leaf.state)
+    return leaves.values()
+
+
+def _top_is_ranked(scores, top_k=1, z=INTERVAL_Z, min_sims=RANKING_MIN_SIMS):
+    """Return True if each of the top_k scores is above the next score by
+    more than z standard errors of each of their means over sims.
+
+    It is never True with fewer than min_sims of a compared score or when
+    the sims of both compared scores agree exactly, since that spread says
+    nothing about how more sims would turn out.
+
+    Arguments:
+    scores: (score, per sim scores) sorted from best to worst
+    """
+    for (better, better_sims), (worse, worse_sims) in zip(scores[:top_k],
+                                                          scores[1:top_k + 1]):
+        if min(len(better_sims), len(worse_sims)) < max(2, min_sims):
+            return False
+        better_error = _standard_error(better_sims)
+        worse_error = _standard_error(worse_sims)
+        if not (better_error or worse_error):
+            return False
+        if better - z * better_error <= worse + z * worse_error:
+            return False
+    return True
+
+
+def _score_spread(score, sim_scores, z=INTERVAL_Z):
+    """Return the variance of sim_scores and the confidence interval of
+    score or (None, None) when there are too few sims."""
+    if len(sim_scores) < 2:
+        return None, None
+    variance = float(numpy.var(sim_scores, ddof=1))
+    margin = z * _standard_error(sim_scores)
+    return variance, (score - margin, score + margin)
+
+
+def _standard_error(values):
+    """Return the standard error of the mean of values."""
+    if len(values) < 2:
+        return float('inf')
+    return numpy.std(values, ddof=1) / numpy.sqrt(len(values))
+
+
 if __name__ == '__main__':
     pass
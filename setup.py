@@ -1,9 +1,24 @@
 try:
-    from setuptools import setup, find_packages
+    from setuptools import setup, find_packages, Command
 except ImportError:
     from distribute_setup import use_setuptools
     use_setuptools()
-    from setuptools import setup, find_packages
+    from setuptools import setup, find_packages, Command
+
+
+class BuildTemplates(Command):
+    description = 'build the template pack (pqhelper/data/templates.npz)'
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        from pqhelper.base import StateInvestigator
+        StateInvestigator.build_template_pack()
 
 
 setup(
@@ -11,7 +26,8 @@ setup(
     version='0.1.2.3',
     py_modules=['distribute_setup'],
     packages=find_packages(),
-    package_data={'': ['*.png']},
+    package_data={'': ['*.png', '*.npz']},
+    cmdclass={'build_templates': BuildTemplates},
     install_requires=['numpy', 'treenode', 'investigators'],
     tests_require=['mock', 'numpy', 'treenode', 'investigators'],
     url='http://github.com/kobejohn/PQHelper',
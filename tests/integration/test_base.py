@@ -1,12 +1,19 @@
+import shutil
+import tempfile
 import unittest
+import warnings
 from os import path
 
 from mock import patch
+import numpy
 from investigators.visuals import cv2
 
-from pqhelper.base import Actor, Board, Tile
+import pqhelper.data as pq_data
+from pqhelper.base import Actor, Board, Tile, RandomFill, SwapOrdering
 from pqhelper.base import BaseTransition, Swap, ChainReaction, EOT, Filtered
-from pqhelper.base import Game, State, StateInvestigator
+from pqhelper.base import Chance, ManaDrain, Transposition
+from pqhelper.base import Game, State, StateInvestigator, BatchIdentifier
+from pqhelper.base import TankReader, ChangeWatcher
 
 from pqhelper.base import TreeNode
 
@@ -27,8 +34,9 @@ class Test_StateInvestigator(unittest.TestCase):
     def test_get_capture_returns_None_if_tile_can_not_be_identified(self):
         si = StateInvestigator()
         identifier = si._board_tools['tile_id']
-        with patch.object(identifier, 'identify') as m_identify:
-            m_identify.return_value = None
+        with patch.object(identifier, 'identify_many') as m_identify:
+            m_identify.side_effect = lambda tiles: ([None] * len(tiles),
+                                                    [0] * len(tiles))
             board = si.get_capture()
         self.assertIsNone(board)
 
@@ -36,8 +44,9 @@ class Test_StateInvestigator(unittest.TestCase):
         # because there shouldn't be one but a misidentified screen can do this
         si = StateInvestigator()
         identifier = si._board_tools['tile_id']
-        with patch.object(identifier, 'identify') as m_identify:
-            m_identify.return_value = '.'
+        with patch.object(identifier, 'identify_many') as m_identify:
+            m_identify.side_effect = lambda tiles: (['.'] * len(tiles),
+                                                    [0] * len(tiles))
             board, player, opponent, extra_actions = si.get_versus()
         self.assertIsNone(board)
 
@@ -60,6 +69,38 @@ class Test_StateInvestigator(unittest.TestCase):
             board = si.get_capture()
         self.assertEqual(str(board), board_string_spec)
 
+    def test_get_capture_records_the_match_value_of_each_tile(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'capture.png'))
+        board = si.get_capture(screen)
+        positions = [p for p, tile in board.positions_with_tile()]
+        self.assertEqual(sorted(si.tile_match_values), sorted(positions))
+        for match_value in si.tile_match_values.values():
+            self.assertLessEqual(match_value, 0.2)
+
+    def test_unchanged_tiles_keep_their_match_values(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        si.get_versus(screen)
+        match_values_spec = dict(si.tile_match_values)
+        si.get_versus(screen)
+        self.assertEqual(si.tile_match_values, match_values_spec)
+
+    def test_tile_match_values_are_None_if_game_can_not_be_found(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        si.get_versus(screen)
+        finder = si._game_finders['versus']
+        with patch.object(si, '_revalidated_game_rect') as m_revalidated:
+            m_revalidated.return_value = None
+            with patch.object(finder, 'locate_in') as m_locate_in:
+                m_locate_in.return_value = None
+                si.get_versus(screen)
+        self.assertIsNone(si.tile_match_values)
+
     # Versus
     def test_get_versus_returns_4xNone_if_game_can_not_be_found_on_screen(self):
         si = StateInvestigator()
@@ -75,8 +116,9 @@ class Test_StateInvestigator(unittest.TestCase):
     def test_get_versus_returns_None_board_if_tile_can_not_be_identified(self):
         si = StateInvestigator()
         identifier = si._board_tools['tile_id']
-        with patch.object(identifier, 'identify') as m_identify:
-            m_identify.return_value = None
+        with patch.object(identifier, 'identify_many') as m_identify:
+            m_identify.side_effect = lambda tiles: ([None] * len(tiles),
+                                                    [0] * len(tiles))
             board, player, opponent, extra_actions = si.get_versus()
         self.assertIsNone(board)
 
@@ -84,8 +126,9 @@ class Test_StateInvestigator(unittest.TestCase):
         # because there shouldn't be any but a misidentified screen can do this
         si = StateInvestigator()
         identifier = si._board_tools['tile_id']
-        with patch.object(identifier, 'identify') as m_identify:
-            m_identify.return_value = '.'
+        with patch.object(identifier, 'identify_many') as m_identify:
+            m_identify.side_effect = lambda tiles: (['.'] * len(tiles),
+                                                    [0] * len(tiles))
             board, player, opponent, extra_actions = si.get_versus()
         self.assertIsNone(board)
 
@@ -153,6 +196,93 @@ class Test_StateInvestigator(unittest.TestCase):
         extra_actions_spec = 3
         self.assertEqual(extra_actions, extra_actions_spec)
 
+    def test_get_versus_revalidates_the_last_game_location(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        finder = si._game_finders['versus']
+        with patch.object(si, '_screen_shot') as m_screen_shot:
+            m_screen_shot.return_value = screen
+            board_spec = si.get_versus()[0]
+            with patch.object(finder, 'locate_in') as m_locate_in:
+                board = si.get_versus()[0]
+        self.assertFalse(m_locate_in.called)
+        self.assertEqual(str(board), str(board_spec))
+
+    def test_get_versus_searches_again_if_the_game_moved_away(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        finder = si._game_finders['versus']
+        with patch.object(si, '_screen_shot') as m_screen_shot:
+            m_screen_shot.return_value = screen
+            si.get_versus()
+            m_screen_shot.return_value = 255 - screen
+            with patch.object(finder, 'locate_in') as m_locate_in:
+                m_locate_in.return_value = None
+                parts = si.get_versus()
+        self.assertTrue(m_locate_in.called)
+        self.assertEqual(parts, (None, None, None, None))
+
+    def test_get_versus_resizes_templates_once_per_size(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        with patch.object(si, '_screen_shot') as m_screen_shot:
+            m_screen_shot.return_value = screen
+            for _ in range(2):
+                si.get_versus()  # find the game and then revalidate it
+            with patch('investigators.visuals.TemplateFinder') as m_finder:
+                extra_actions = si.get_versus()[3]
+        self.assertFalse(m_finder.called)
+        self.assertEqual(extra_actions, 3)
+
+    def test_game_signature_changes_only_when_the_game_changes(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        changed_screen = screen.copy()
+        changed_screen[81:127, 135:181] = screen[81:127, 181:227]  # a tile
+        watcher = ChangeWatcher()
+        with patch.object(si, '_screen_shot') as m_screen_shot:
+            m_screen_shot.return_value = screen
+            signature = si.game_signature('versus')
+            same_signature = si.game_signature('versus')
+            m_screen_shot.return_value = changed_screen
+            changed_signature = si.game_signature('versus')
+        self.assertTrue(watcher._same(signature, same_signature))
+        self.assertFalse(watcher._same(signature, changed_signature))
+
+    def test_game_signature_is_None_if_game_can_not_be_found(self):
+        si = StateInvestigator()
+        finder = si._game_finders['versus']
+        with patch.object(finder, 'locate_in') as m_locate_in:
+            m_locate_in.return_value = None
+            self.assertIsNone(si.game_signature('versus'))
+
+    def test_get_versus_identifies_only_the_tiles_that_changed(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        changed_screen = screen.copy()
+        changed_screen[81:127, 135:181] = screen[81:127, 181:227]  # a tile
+        identifier = si._board_tools['tile_id']
+        with patch.object(si, '_screen_shot') as m_screen_shot:
+            m_screen_shot.return_value = screen
+            si.get_versus()
+            m_screen_shot.return_value = changed_screen
+            with patch.object(identifier, 'identify_many',
+                              wraps=identifier.identify_many) as m_identify:
+                board = si.get_versus()[0]
+        tiles = m_identify.call_args[0][0]
+        self.assertEqual(len(tiles), 1)
+        self.assertTrue(str(board).startswith('mmrbmsgs'))
+
+    def test_tools_are_built_on_first_use_and_shared(self):
+        first_tools = StateInvestigator()._board_tools
+        self.assertIs(StateInvestigator()._board_tools, first_tools)
+        self.assertIs(StateInvestigator.__dict__['_board_tools'], first_tools)
+
     def test_generic_versus_actors_produces_average_player_and_opponent(self):
         # this is a stopgap until actor investigation is implemented
         si = StateInvestigator()
@@ -180,6 +310,159 @@ class Test_StateInvestigator(unittest.TestCase):
             self.assertEqual(actor.h_max, unused_max_spec)
             self.assertEqual(actor.c_max, unused_max_spec)
 
+    # Template pack
+    def test_build_template_pack_maps_originals_and_prescaled_variants(self):
+        pack_path = path.join(tempfile.mkdtemp(), 'templates.npz')
+        self.addCleanup(shutil.rmtree, path.dirname(pack_path))
+        StateInvestigator.build_template_pack(pack_path)
+        self.addCleanup(self._reset_template_cache)
+        pack = pq_data._mapped_arrays(pack_path)
+        self.assertIsInstance(pack['versus'], numpy.memmap)
+        self.assertTrue(numpy.array_equal(pack['versus'],
+                                          pq_data._read('versus')))
+        token_size = StateInvestigator._token_size((960, 1280))
+        token = pack[pq_data._key('extra_action', token_size)]
+        self.assertEqual(token.shape[0:2], token_size)
+
+    def test_get_versus_finds_the_same_game_with_the_template_pack(self):
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        board_spec = str(StateInvestigator().get_versus(screen)[0])
+        pack_path = path.join(tempfile.mkdtemp(), 'templates.npz')
+        self.addCleanup(shutil.rmtree, path.dirname(pack_path))
+        StateInvestigator.build_template_pack(pack_path)
+        self.addCleanup(self._reset_template_cache)
+        with patch.object(pq_data, 'PACK_PATH', pack_path):
+            self._reset_template_cache()
+            board = StateInvestigator().get_versus(screen)[0]
+            self.assertIsInstance(pq_data.versus_template(), numpy.memmap)
+        self.assertEqual(str(board), board_spec)
+
+    def test_a_pack_of_other_images_is_ignored_with_a_warning(self):
+        pack_path = path.join(tempfile.mkdtemp(), 'templates.npz')
+        self.addCleanup(shutil.rmtree, path.dirname(pack_path))
+        StateInvestigator.build_template_pack(pack_path)
+        self.addCleanup(self._reset_template_cache)
+        other_digest = numpy.zeros(20, dtype=numpy.uint8)
+        with patch.object(pq_data, 'PACK_PATH', pack_path), \
+                patch.object(pq_data, '_source_digest',
+                             lambda: other_digest), \
+                warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self._reset_template_cache()
+            template = pq_data.versus_template()
+        self.assertNotIsInstance(template, numpy.memmap)
+        self.assertEqual(len(caught), 1)
+        self.assertIn(pack_path, str(caught[0].message))
+
+    def _reset_template_cache(self):
+        pq_data._images.clear()
+        pq_data._pack = None
+        StateInvestigator._sized_finders.clear()
+
+
+class Test_BatchIdentifier(unittest.TestCase):
+    def test_identify_many_identifies_each_template_with_best_match(self):
+        templates = pq_data.tile_templates()
+        identifier = BatchIdentifier(templates, acceptable_threshold=0.2)
+        names = sorted(templates)
+        found, match_values = identifier.identify_many([templates[name]
+                                                        for name in names])
+        self.assertEqual(found, names)
+        for match_value in match_values:
+            self.assertAlmostEqual(match_value, 0)
+
+    def test_identify_many_returns_None_for_unacceptable_matches(self):
+        identifier = BatchIdentifier(pq_data.tile_templates(),
+                                     acceptable_threshold=0.2)
+        white = numpy.empty((50, 50, 3), dtype=numpy.uint8)
+        white.fill(255)
+        found, match_values = identifier.identify_many([white])
+        self.assertEqual(found, [None])
+        self.assertGreater(match_values[0], 0.2)
+
+    def test_identify_many_compares_only_ambiguous_images_at_full_size(self):
+        templates = pq_data.tile_templates()
+        identifier = BatchIdentifier(templates, acceptable_threshold=0.2,
+                                     ambiguous='23')
+        images = [templates[name] for name in 'r23g']
+        with patch.object(identifier, '_stacked',
+                          wraps=identifier._stacked) as m_stacked:
+            found, match_values = identifier.identify_many(images)
+        self.assertEqual(found, list('r23g'))
+        full_size_images = m_stacked.call_args_list[-1][0][0]
+        self.assertEqual(len(full_size_images), 2)
+        self.assertIs(full_size_images[0], images[1])
+        self.assertIs(full_size_images[1], images[2])
+
+    def test_identify_many_by_signature_agrees_with_full_comparison(self):
+        si = StateInvestigator()
+        here = path.abspath(path.split(__file__)[0])
+        screen = cv2.imread(path.join(here, 'versus.png'))
+        game_image = si._game_image_from_screen('versus', screen)
+        t, l, b, r = si._board_tools['board_region'].region_in(game_image)
+        board_image = game_image[t:b, l:r]
+        grid = si._board_tools['grid']
+        tiles = [board_image[t:b, l:r] for position, (t, l, b, r)
+                 in grid.borders_by_grid_position(board_image)]
+        templates = pq_data.tile_templates()
+        full = BatchIdentifier(templates, acceptable_threshold=0.2,
+                               signature_size=None)
+        found, match_values = si._board_tools['tile_id'].identify_many(tiles)
+        self.assertEqual(found, full.identify_many(tiles)[0])
+
+
+class Test_TankReader(unittest.TestCase):
+    fill, empty, ignore = (0, 0, 200), (50, 50, 50), (0, 0, 0)
+
+    def _tank_image(self):
+        # left tank fills from the bottom and right tank from the left
+        image = numpy.zeros((100, 100, 3), dtype=numpy.uint8)
+        image[10:90, 10:30] = self.empty
+        image[60:90, 10:30] = self.fill  # 30 of 80 rows
+        image[40:60, 40:90] = self.empty
+        image[40:60, 40:80] = self.fill  # 40 of 50 columns
+        return image
+
+    def test_levels_reads_every_tank_in_the_image(self):
+        colors = self.fill, self.empty, self.ignore
+        reader = TankReader([((0.05, 0.05, 0.95, 0.35), colors, False),
+                             ((0.35, 0.35, 0.65, 0.95), colors, True)])
+        upright, sideways = reader.levels(self._tank_image())
+        self.assertAlmostEqual(upright, 30.0 / 80)
+        self.assertAlmostEqual(sideways, 40.0 / 50)
+
+    def test_levels_returns_None_for_tanks_that_are_not_found(self):
+        colors = self.fill, self.empty, self.ignore
+        reader = TankReader([((0.0, 0.0, 0.05, 0.05), colors, False)])
+        self.assertEqual(reader.levels(self._tank_image()), [None])
+
+
+class Test_ChangeWatcher(unittest.TestCase):
+    def test_settled_change_is_True_once_for_each_settled_change(self):
+        watcher = ChangeWatcher()
+        first = numpy.zeros(10, dtype=numpy.uint8)
+        moving = first + 100
+        second = first + 200
+        signatures = first, first, first, moving, second, second, second
+        changes = [watcher.settled_change(signature)
+                   for signature in signatures]
+        self.assertEqual(changes,
+                         [False, True, False, False, False, True, False])
+
+    def test_settled_change_ignores_small_differences(self):
+        watcher = ChangeWatcher(threshold=16)
+        first = numpy.zeros(10, dtype=numpy.uint8)
+        watcher.settled_change(first)
+        watcher.settled_change(first)
+        self.assertFalse(watcher.settled_change(first + 10))
+        self.assertFalse(watcher.settled_change(first + 10))
+
+    def test_settled_change_is_False_without_a_game(self):
+        watcher = ChangeWatcher()
+        self.assertFalse(watcher.settled_change(None))
+        self.assertFalse(watcher.settled_change(None))
+
 
 class Test_Game(unittest.TestCase):
     """Confirm that Game simulates a game of PQ."""
@@ -231,6 +514,81 @@ class Test_Game(unittest.TestCase):
         game = generic_game()
         confirm_attribute(game, 'random_fill')
 
+    def test_Game_with_the_same_seed_simulates_the_same_random_fills(self):
+        results = list()
+        for i in range(2):
+            game = Game(True, seed=3)
+            root = generic_state(board=Board(self.board_string_two_paths))
+            eots = game.ends_of_one_state(root=root)
+            results.append(sorted(str(eot.parent.board) for eot in eots))
+        self.assertEqual(results[0], results[1])
+
+    def test_sims_split_by_random_fill_are_attached_by_chance(self):
+        game = Game(True, seed=1, sims=8)
+        root = generic_state(board=Board(self.board_string_two_paths))
+        list(game.ends_of_one_state(root=root))
+        for swap in root.children:
+            chances = swap.children
+            self.assertTrue(all(isinstance(c, Chance) for c in chances))
+            total_weight = sum(chance.weight for chance in chances)
+            self.assertAlmostEqual(total_weight, 1)
+            all_sims = 0
+            for chance in chances:
+                result_state = chance.children[0]
+                self.assertFalse(all_sims & result_state.sims)
+                all_sims |= result_state.sims
+            self.assertEqual(all_sims, (1 << 8) - 1)
+
+    def test_sims_share_the_swaps_before_the_first_random_fill(self):
+        single = Game(True, seed=1, sims=1)
+        several = Game(True, seed=1, sims=4)
+        swap_counts = list()
+        for game in (single, several):
+            root = generic_state(board=Board(self.board_string_two_paths))
+            list(game.ends_of_one_state(root=root))
+            swaps = [swap.position_pair for swap in root.children]
+            self.assertEqual(len(swaps), len(set(swaps)))
+            swap_counts.append(len(swaps))
+        self.assertEqual(swap_counts[0], swap_counts[1])
+
+    def test_sims_with_identical_random_fills_share_one_result(self):
+        # 8 sims filling 1 blank from 7 tile types must repeat a result
+        sims = 8
+        game = Game(True, seed=1, sims=sims)
+        board = Board('.byxmgrs\n'
+                      'ybbmymrs\n'
+                      'xxbxmbxs\n'
+                      'brmmggxb\n'
+                      'gbxgbxry\n'
+                      'bxrgsrgg\n'
+                      'rsrryysy\n'
+                      'sggmbsrx')
+        outcomes, = game._refilled_outcomes(0, [board])
+        self.assertLess(len(outcomes), sims)
+        self.assertEqual(len(set(str(b) for s, b in outcomes)), len(outcomes))
+        self.assertEqual(sum(bin(s).count('1') for s, b in outcomes), sims)
+
+    def test_expected_refill_gives_root_swaps_one_estimated_outcome(self):
+        game = Game(True, seed=1, sims=8, expected_refill=True)
+        root = generic_state(board=Board(self.board_string_two_paths))
+        list(game.ends_of_one_state(root=root))
+        for swap in root.children:
+            gains, attack = swap.expected_refill
+            self.assertEqual(len(gains), 9)
+            result_state, = swap.children
+            self.assertIsInstance(result_state, State)
+
+    def test_expected_refill_gains_stop_at_the_max_values(self):
+        game = Game(True, seed=1, sims=1, expected_refill=True)
+        full = Actor('player', (50, 100), (5, 5), (5, 5), (5, 5), (5, 5),
+                     (5, 5), (5, 5), (5, 5), (5, 5))
+        root = generic_state(board=Board(self.board_string_two_paths),
+                             player=full)
+        list(game.ends_of_one_state(root=root))
+        for swap in root.children:
+            gains, attack = swap.expected_refill
+            self.assertFalse(gains.any())
+
     # Run simulation of one turn for one state
     def test_ends_of_one_state_raises_TypeError_if_not_exactly_one_arg(self):
         game = generic_game()
@@ -332,6 +690,85 @@ class Test_Game(unittest.TestCase):
         leaf = eots[0]
         self.assertEqual(leaf.parent.board, Board())
 
+    def test_ends_of_one_state_ends_the_game_when_an_actor_is_defeated(self):
+        game = generic_game(False)
+        board_string_skulls = '........\n' \
+                              '........\n' \
+                              '........\n' \
+                              '........\n' \
+                              '........\n' \
+                              '........\n' \
+                              '........\n' \
+                              'srssgbgg'
+        opponent = generic_actor('opponent', health=(3, 100))
+        root = generic_state(board=Board(board_string_skulls),
+                             opponent=opponent)
+        eots = list(game.ends_of_one_state(root=root))
+        terminal_eots = [eot for eot in eots if eot.is_terminal]
+        self.assertEqual(len(terminal_eots), 1)
+        terminal_eot, = terminal_eots
+        self.assertEqual(terminal_eot.parent.opponent.health, 0)
+        self.assertFalse(terminal_eot.is_mana_drain)
+        # the next turn does not continue after the game is over
+        list(game.ends_of_next_whole_turn(root))
+        self.assertEqual(len(terminal_eot.children), 0)
+
+    def test_actors_without_health_are_never_defeated(self):
+        game = generic_game(False)
+        v = (0, 0)
+        stub_actor = Actor('capture', v, v, v, v, v, v, v, v, v)
+        root = generic_state(board=Board(self.board_string_two_paths),
+                             player=stub_actor, opponent=stub_actor)
+        eots = list(game.ends_of_one_state(root=root))
+        self.assertFalse(any(eot.is_terminal for eot in eots))
+
+    board_string_independent_swaps = '........\n' \
+                                     '........\n' \
+                                     '........\n' \
+                                     '........\n' \
+                                     '........\n' \
+                                     '........\n' \
+                                     '........\n' \
+                                     'rrgrbbyb'
+
+    def test_ends_of_one_state_simulates_transposed_actions_once(self):
+        game = generic_game(False)
+        root = generic_state(board=Board(self.board_string_independent_swaps),
+                             actions_remaining=2)
+        eots = list(game.ends_of_one_state(root=root))
+        transpositions = [node for node in root.post_order_nodes()
+                          if isinstance(node, Transposition)]
+        # red then green is the same as green then red
+        self.assertEqual(len(transpositions), 1)
+        self.assertEqual(len(eots), 1)
+        transposed = transpositions[0].parent
+        self.assertEqual(str(transposed.board),
+                         str(transpositions[0].state.board))
+
+    def test_states_of_different_sims_are_not_transpositions(self):
+        game = Game(True, seed=1, sims=2)
+        board = Board(self.board_string_two_paths)
+        seen_states = dict()
+        player, opponent = generic_actor(), generic_actor()
+        state = lambda sims: State(board.copy(), player, opponent, 1, 1,
+                                   sims=sims)
+        first, other_sims, same_sims = state(1), state(2), state(1)
+        self.assertIsNone(game._transposed_state(first, seen_states))
+        self.assertIsNone(game._transposed_state(other_sims, seen_states))
+        self.assertIs(game._transposed_state(same_sims, seen_states), first)
+
+    def test_beam_width_limits_swaps_after_the_first_action(self):
+        game = generic_game(False)
+        game.beam_width = 1
+        root = generic_state(board=Board(self.board_string_two_paths),
+                             actions_remaining=3)
+        list(game.ends_of_one_state(root=root))
+        self.assertEqual(len(root.children), 2)
+        for node in root.post_order_nodes():
+            if isinstance(node, State) and node is not root:
+                swaps = [c for c in node.children if isinstance(c, Swap)]
+                self.assertLessEqual(len(swaps), 1)
+
     def test_ends_of_one_state_attaches_mana_drain_to_blank_root(self):
         game = generic_game(False)
         root = generic_state(board=Board())
@@ -380,6 +817,29 @@ class Test_Game(unittest.TestCase):
                          'Unexpectedly found destructions when the board'
                          ' should be stable')
 
+    def test_ends_of_one_state_draws_a_mana_drain_board_for_each_sim(self):
+        game = Game(True, seed=1, sims=2)
+        root = generic_state(board=Board())
+        ends_of_turn = list(game.ends_of_one_state(root=root))
+        mana_drain, = root.children
+        self.assertIsInstance(mana_drain, ManaDrain)
+        self.assertEqual(len(ends_of_turn), 2)
+        drained_states = [eot.parent for eot in ends_of_turn]
+        self.assertEqual(sorted(state.sims for state in drained_states),
+                         [0b01, 0b10])
+        self.assertNotEqual(str(drained_states[0].board),
+                            str(drained_states[1].board))
+        for eot, state in zip(ends_of_turn, drained_states):
+            self.assertTrue(eot.is_mana_drain)
+            self.assertEqual(state.actions_remaining, 0)
+            self.assertFalse(state.player.r or state.opponent.r)
+            self.assertAlmostEqual(state.parent.weight, 0.5)
+
+    def test_Game_sims_must_fit_in_the_sims_bit_mask(self):
+        self.assertRaises(ValueError, Game, True, sims=0)
+        self.assertRaises(ValueError, Game, True, sims=64)
+        Game(True, sims=63)
+
     @patch('pqhelper.base.Game._disallow_state', lambda *args: True)
     def test_ends_of_one_state_attaches_Filtered_when_a_state_fails_test(self):
         game = generic_game(False)
@@ -678,6 +1138,54 @@ class Test_State(unittest.TestCase):
         self.assertIs(even_state.passive, even_state.player)
         self.assertIs(even_state.active, even_state.opponent)
 
+    # arena storage
+    def test_State_copies_actor_values_rather_than_keeping_the_actors(self):
+        player = generic_actor(name='player', health=(50, 100))
+        state = generic_state(player=player)
+        player.health = 10
+        self.assertEqual(state.player.health, 50)
+
+    def test_States_of_one_simulation_share_one_arena(self):
+        game = generic_game()
+        root = generic_state(board=Board(Test_Game.board_string_two_paths))
+        list(game.ends_of_one_state(root=root))
+        for eot in root.leaves():
+            self.assertIs(eot.parent.arena, root.arena)
+        node_ids = [node.node_id for node in root.post_order_nodes()
+                    if isinstance(node, State)]
+        self.assertEqual(len(set(node_ids)), len(node_ids))
+
+    def test_State_actor_changes_are_stored_in_the_arena(self):
+        state = generic_state(player=generic_actor(health=(50, 100)))
+        state.player.apply_attack(20)
+        state.actions_remaining = 0
+        arena_player, arena_opponent = state.arena.actors(state.node_id)
+        self.assertEqual(arena_player.health, 30)
+        self.assertEqual(state.arena.actions_remaining(state.node_id), 0)
+
+    def test_arena_reuses_the_rows_of_released_states(self):
+        root = generic_state()
+        arena = root.arena
+        first = State(Board(), root.player, root.opponent, 2, 1,
+                      arena=arena)
+        arena.release([first.node_id])
+        self.assertEqual(len(arena), 1)
+        second = State(Board(), root.player, root.opponent, 3, 0,
+                       arena=arena)
+        self.assertEqual(second.node_id, first.node_id)
+        self.assertEqual(len(arena), 2)
+        self.assertEqual((second.turn, second.actions_remaining), (3, 0))
+
+    def test_arena_stats_gathers_values_across_blocks(self):
+        arena = generic_state().arena
+        arena._BLOCK_SIZE = 2  # small blocks to cross block boundaries
+        states = [State(Board(), generic_actor(health=(health, 100)),
+                        generic_actor(), 1, 1, arena)
+                  for health in (10, 20, 30, 40)]
+        stats = arena.stats([state.node_id for state in reversed(states)])
+        self.assertEqual(stats.shape, (4, 2, 9))
+        self.assertEqual(list(stats[:, 0, 0]), [40, 30, 20, 10])
+
     # special methods
     def test_State_has_a_human_readable_string_with_primary_attributes(self):
         state = generic_state()
@@ -1529,6 +2037,112 @@ class Test_Transitions(unittest.TestCase):
             self.assertIn(required_string, transition_str)
 
 
+class Test_RandomFill(unittest.TestCase):
+    def test_fill_many_fills_every_blank_of_every_board(self):
+        boards = [Board() for _ in range(3)]
+        boards[0][(7, 0)] = Tile('h')
+        RandomFill().fill_many(boards)
+        for board in boards:
+            for p, tile in board.positions_with_tile():
+                self.assertFalse(tile.is_blank())
+        self.assertEqual(boards[0][(7, 0)], Tile('h'))
+
+    def test_fill_uses_only_random_weights_tile_types(self):
+        board = Board()
+        RandomFill().fill(board)
+        for p, tile in board.positions_with_tile():
+            self.assertIn(tile._type, Tile._random_weights)
+
+    def test_fills_with_the_same_seed_are_the_same(self):
+        board_1, board_2 = Board(), Board()
+        RandomFill(seed=5).fill(board_1)
+        RandomFill(seed=5).fill(board_2)
+        self.assertEqual(str(board_1), str(board_2))
+
+    # one blank that only makes a line of 3 when filled with red
+    one_red_line_board_string = 'hchchchc\n' \
+                                'chchchch\n' \
+                                'hchchchc\n' \
+                                'chchchch\n' \
+                                'hchchchc\n' \
+                                'chchchch\n' \
+                                'hchchchc\n' \
+                                'rr.chchc'
+
+    def test_expected_cascade_counts_lines_completed_by_blanks(self):
+        board = Board(self.one_red_line_board_string)
+        expected = RandomFill().expected_cascade(board)
+        red_odds = float(Tile._random_weights['r']) \
+            / sum(Tile._random_weights.values())
+        self.assertAlmostEqual(expected['r'], 3 * red_odds)
+        self.assertEqual(sum(expected.values()), expected['r'])
+
+    def test_fill_without_cascade_avoids_new_lines(self):
+        for seed in range(10):
+            board = Board(self.one_red_line_board_string)
+            self.assertTrue(RandomFill(seed).fill_without_cascade(board))
+            self.assertNotEqual(board[(7, 2)], Tile('r'))
+            self.assertNotEqual(board[(7, 2)], Tile('.'))
+
+    def test_spawn_seeds_are_reproducible_and_independent(self):
+        seeds = RandomFill(seed=5).spawn_seeds(3)
+        self.assertEqual(seeds, RandomFill(seed=5).spawn_seeds(3))
+        self.assertEqual(len(set(seeds)), 3)
+
+
+class Test_SwapOrdering(unittest.TestCase):
+    board_string = '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   'r.......\n' \
+                   'r....g..\n' \
+                   'gr.ggrg.'
+
+    def valid_swaps(self, state):
+        valid_swaps = list()
+        for swap_pair in state.board.potential_swaps():
+            result_board, destroyed_groups = \
+                state.board.execute_once(swap=swap_pair)
+            if destroyed_groups:
+                valid_swaps.append((swap_pair, result_board,
+                                    destroyed_groups))
+        return valid_swaps
+
+    def test_ordered_puts_extra_action_swaps_first(self):
+        state = generic_state(board=Board(self.board_string))
+        ordered = SwapOrdering().ordered(state, self.valid_swaps(state))
+        swap_pairs = [swap_pair for swap_pair, _, _ in ordered]
+        # the 4 greens make an extra action
+        self.assertEqual(swap_pairs[0], ((6, 5), (7, 5)))
+        self.assertEqual(len(swap_pairs), 3)
+
+    def test_ordered_breaks_ties_with_rewarded_swaps(self):
+        state = generic_state(board=Board(self.board_string))
+        # the two 3 matches are equal except for the reward
+        for rewarded in (((7, 0), (7, 1)), ((7, 5), (7, 6))):
+            ordering = SwapOrdering()
+            ordering.reward(rewarded)
+            ordered = ordering.ordered(state, self.valid_swaps(state))
+            swap_pairs = [swap_pair for swap_pair, _, _ in ordered]
+            self.assertEqual(swap_pairs[1], rewarded)
+
+    def test_ordered_prefers_killer_swaps_of_the_same_turn_over_history(self):
+        state = generic_state(board=Board(self.board_string))
+        often, killer = ((7, 0), (7, 1)), ((7, 5), (7, 6))
+        ordering = SwapOrdering()
+        ordering.reward(often, amount=5)
+        ordering.reward(killer, turn=state.turn + 1)
+        swap_pairs = [swap_pair for swap_pair, _, _
+                      in ordering.ordered(state, self.valid_swaps(state))]
+        self.assertEqual(swap_pairs[1], often)  # killer of another turn
+        ordering.reward(killer, turn=state.turn)
+        swap_pairs = [swap_pair for swap_pair, _, _
+                      in ordering.ordered(state, self.valid_swaps(state))]
+        self.assertEqual(swap_pairs[1], killer)
+
+
 class Test_Actor(unittest.TestCase):
     # Common data
     __max_suffix = '_max'
@@ -1581,6 +2195,18 @@ class Test_Actor(unittest.TestCase):
                              ''.format(attribute_name,
                                        original_value, copied_value))
 
+    def test_max_values_can_be_changed_without_changing_copies(self):
+        actor = generic_actor(health=(50, 100))
+        copied = actor.copy()
+        actor.health_max = 80
+        self.assertEqual(actor.health_max, 80)
+        self.assertEqual(copied.health_max, 100)
+
+    def test_max_values_of_state_actors_can_not_be_changed(self):
+        state = generic_state()
+        self.assertRaises(AttributeError, setattr, state.player,
+                          'health_max', 1)
+
     def test_apply_mana_drain_sets_current_mana_to_zero(self):
         mana_types = ('r', 'g', 'b', 'y')
         non_zero_mana = {mana_type: (50, 100) for mana_type in mana_types}
@@ -1655,6 +2281,25 @@ class Test_Actor(unittest.TestCase):
         attack_value_spec = 1 + 1 + 5
         self.assertGreaterEqual(attack_value, attack_value_spec)
 
+    def test_apply_tile_groups_limits_increases_to_max_values(self):
+        actor = generic_actor(r=(8, 10), x=(0, 100))
+        red = Tile('r')
+        tile_groups = [(red, red, red), (red, Tile('2'), red),
+                       (Tile('x'),) * 3]
+        actor.apply_tile_groups(tile_groups)
+        self.assertEqual(actor.r, 10)
+        self.assertEqual(actor.x, 3)
+
+    def test_Actor_has_no_per_instance_dict(self):
+        actor = generic_actor()
+        self.assertFalse(hasattr(actor, '__dict__'))
+
+    def test_Actors_are_equal_only_with_equal_name_and_values(self):
+        actor = generic_actor('player')
+        self.assertEqual(actor, actor.copy())
+        self.assertNotEqual(actor, generic_actor('opponent'))
+        self.assertNotEqual(actor, generic_actor('player', health=(1, 100)))
+
     def test_apply_attack_affects_current_health(self):
         base = 50
         actor = generic_actor(health=(base, 100))
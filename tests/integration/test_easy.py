@@ -0,0 +1,226 @@
+from Queue import Queue
+from threading import Thread
+import time
+import unittest
+
+from mock import patch
+import numpy
+
+from pqhelper import easy
+from pqhelper.base import Actor, Board, Summary, State
+from pqhelper.base import ChainReaction, Transposition
+
+
+class Test_summary_deltas(unittest.TestCase):
+    board_string = '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '8..*..g.\n' \
+                   '8..s..g.\n' \
+                   'xr.xs.xg'
+
+    def summaries(self, *scores):
+        board = Board(self.board_string)
+        actions = (((7, 0), (7, 1)), ((7, 3), (7, 4)), ((7, 6), (7, 7)))
+        summaries = [Summary(board, action, score, 0, 2, 1.0,
+                             (score - 1, score + 1))
+                     for action, score in zip(actions, scores)]
+        summaries.sort(key=lambda summary: summary.score, reverse=True)
+        return summaries
+
+    def test_first_delta_has_the_board_and_every_summary(self):
+        q = Queue()
+        easy._put_summary_deltas(q, self.summaries(1, 2, 3), dict())
+        board_string, changes = q.get_nowait()
+        self.assertEqual(board_string, self.board_string)
+        self.assertEqual(len(changes), 3)
+
+    def test_deltas_round_trip_to_the_same_summaries(self):
+        q = Queue()
+        sent = dict()
+        received = list()
+        for summaries in (self.summaries(1, 2, 3), self.summaries(3, 2, 1)):
+            easy._put_summary_deltas(q, summaries, sent)
+            received = easy.apply_summary_deltas(received, q.get_nowait())
+            self.assertEqual(received, summaries)
+
+    def test_later_deltas_have_only_the_changes_without_the_board(self):
+        q = Queue()
+        sent = dict()
+        easy._put_summary_deltas(q, self.summaries(1, 2, 3), sent)
+        q.get_nowait()
+        # only the last action changes score and the first two swap ranks
+        easy._put_summary_deltas(q, self.summaries(1, 2, 0), sent)
+        board_string, changes = q.get_nowait()
+        self.assertIsNone(board_string)
+        changed_ranks = sorted((action, rank)
+                               for action, rank, score, drains, leaves,
+                               variance, interval in changes)
+        self.assertEqual(changed_ranks, [(((7, 0), (7, 1)), 1),
+                                         (((7, 3), (7, 4)), 0),
+                                         (((7, 6), (7, 7)), 2)])
+
+    def test_nothing_is_put_when_nothing_changed(self):
+        q = Queue()
+        sent = dict()
+        easy._put_summary_deltas(q, self.summaries(1, 2, 3), sent)
+        q.get_nowait()
+        easy._put_summary_deltas(q, self.summaries(1, 2, 3), sent)
+        self.assertTrue(q.empty())
+
+
+class Test_versus_summaries(unittest.TestCase):
+    # the skull match defeats the opponent so it is clearly the best
+    board_string = '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   '........\n' \
+                   'srssgbgg'
+
+    def setUp(self):
+        actor = lambda name, health: Actor(name, health, (50, 100),
+                                           (50, 100), (50, 100), (50, 100),
+                                           (50, 100), (50, 100), (50, 100),
+                                           (50, 100))
+        patcher = patch.object(easy._state_investigator, 'get_versus')
+        m_get = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, easy, '_versus_advisor', None)
+        m_get.side_effect = lambda: (Board(self.board_string),
+                                     actor('player', (50, 100)),
+                                     actor('opponent', (3, 100)), 0)
+
+    def completed_turns(self, seed):
+        easy.versus_summaries(turns=3, sims_to_average=2, seed=seed,
+                              keep_fraction=1.0)
+        return easy._versus_advisor.current_completed_turn
+
+    def test_simulation_stops_early_when_the_top_is_separated(self):
+        # both sims of the second best action have close scores
+        self.assertEqual(self.completed_turns(3), 1)
+
+    def test_simulation_continues_when_the_top_is_in_doubt(self):
+        # only one sim of the second best action also defeats the opponent
+        self.assertEqual(self.completed_turns(0), 3)
+
+
+class Test_versus_watcher(unittest.TestCase):
+    def watched_delays(self, signatures):
+        """Return the delay after each signature until they run out."""
+        delays = list()
+        signatures = iter(signatures)
+        with patch.object(easy, 'versus_signature', signatures.next):
+            with patch.object(easy.time, 'sleep', delays.append):
+                self.assertRaises(StopIteration, easy.versus_watcher,
+                                  Queue(), 0.5, 3.0)
+        return delays
+
+    def test_watcher_backs_off_while_no_game_is_found(self):
+        signature = numpy.zeros(4)
+        delays = self.watched_delays([None] * 4 + [signature, None])
+        self.assertEqual(delays, [1.0, 2.0, 3.0, 3.0, 0.5, 1.0])
+
+
+class WorkerTestCase(unittest.TestCase):
+    """Run versus_worker with worker_kwargs in a thread on a fixed game."""
+    worker_kwargs = dict()
+
+    def setUp(self):
+        board = Board(Test_summary_deltas.board_string)
+        actor = lambda name: Actor(name, (50, 100), (50, 100), (50, 100),
+                                   (50, 100), (50, 100), (50, 100),
+                                   (50, 100), (50, 100), (50, 100))
+        patcher = patch.object(easy._state_investigator, 'get_versus')
+        m_get = patcher.start()
+        self.addCleanup(patcher.stop)
+        # don't leave the simulations of these tests for other analyses
+        self.addCleanup(setattr, easy, '_versus_advisor', None)
+        m_get.side_effect = lambda: (board.copy(), actor('player'),
+                                     actor('opponent'), 0)
+        self.m_get = m_get
+        self.board = board
+        self.requests_q, self.results_q = Queue(), Queue()
+        self.worker = Thread(target=easy.versus_worker,
+                             args=(self.requests_q, self.results_q),
+                             kwargs=self.worker_kwargs)
+        self.worker.daemon = True
+        self.worker.start()
+        # stop pondering before the patches are undone
+        self.addCleanup(self.worker.join, 10)
+        self.addCleanup(self.requests_q.put, None)
+
+    def received(self, request_id):
+        """Request an analysis and return everything received for it."""
+        self.requests_q.put(request_id)
+        received = [self.results_q.get(timeout=10)]
+        while received[-1][1] is not None:
+            received.append(self.results_q.get(timeout=10))
+        return received
+
+
+class Test_versus_worker(WorkerTestCase):
+    worker_kwargs = {'turns': 1, 'sims_to_average': 1, 'ponder_turns': 0}
+
+    def test_worker_tags_each_delta_and_ends_each_request_with_None(self):
+        for request_id in (1, 2):
+            received = self.received(request_id)
+            self.assertEqual(set(tag for tag, delta in received),
+                             set([request_id]))
+            deltas = [delta for tag, delta in received]
+            self.assertIsNone(deltas[-1])
+            self.assertNotIn(None, deltas[:-1])
+            self.assertEqual(deltas[0][0], str(self.board))
+            summaries = list()
+            for delta in deltas[:-1]:
+                summaries = easy.apply_summary_deltas(summaries, delta)
+            self.assertEqual(len(summaries), 3)
+        self.requests_q.put(None)
+        self.worker.join(10)
+        self.assertFalse(self.worker.is_alive())
+
+
+class Test_versus_worker_pondering(WorkerTestCase):
+    worker_kwargs = {'turns': 1, 'sims_to_average': 2, 'ponder_turns': 2,
+                     'beam_width': 1}
+
+    def test_pondered_replies_are_reused_by_the_next_request(self):
+        self.received(1)
+        # wait for the worker to ponder the player's next turn. generous
+        # since the random fills and the machine load vary
+        for i in range(600):
+            advisor = easy._versus_advisor
+            if advisor is not None and advisor.current_completed_turn >= 3:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('Pondering did not complete the next turn in time')
+        # the player's next turn after the opponent's reply and a refill.
+        # prefer a state that only one of the sims reached
+        matches = [node for node in advisor._root.post_order_nodes()
+                   if isinstance(node, State) and node.turn == 3
+                   and node.actions_remaining == 1
+                   and not any(isinstance(child, (ChainReaction,
+                                                  Transposition))
+                               for child in node.children)]
+        matches.sort(key=lambda node: node.sims == 0b11)
+        match = matches[0]
+        self.m_get.side_effect = lambda: (match.board.copy(),
+                                          match.player.copy(),
+                                          match.opponent.copy(), 0)
+        reused = list()
+        advance = advisor.advance
+        with patch.object(advisor, 'advance',
+                          lambda *args: reused.append(advance(*args))):
+            received = self.received(2)
+        self.assertEqual(reused, [True])
+        self.assertIs(easy._versus_advisor, advisor)
+        self.assertEqual(received[0][1][0], str(match.board))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import json
+from os import path
+from StringIO import StringIO
+import unittest
+
+from mock import patch
+
+from pqhelper.base import StateInvestigator
+from pqhelper.offline import analyze_files, image_paths
+
+
+_here = path.abspath(path.split(__file__)[0])
+_versus_path = path.join(_here, 'versus.png')
+_capture_path = path.join(_here, 'capture.png')
+
+
+class Test_offline(unittest.TestCase):
+    def test_image_paths_finds_images_in_directories_in_order(self):
+        found = list(image_paths([_here]))
+        self.assertEqual(found, [_capture_path, _versus_path])
+
+    def test_analyze_files_reads_versus_parts_and_writes_json_lines(self):
+        results_file = StringIO()
+        results = list(analyze_files([_versus_path], processes=1,
+                                     results_file=results_file))
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result['path'], _versus_path)
+        self.assertTrue(result['board'].startswith('smrbmsgs'))
+        self.assertEqual(result['extra_actions'], 3)
+        self.assertEqual(result['player']['health'][1], 100)
+        self.assertEqual(len(result['tile_match_values']), 8)
+        self.assertEqual(len(result['tile_match_values'][0]), 8)
+        self.assertNotIn('summaries', result)
+        lines = results_file.getvalue().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], results)
+
+    def test_analyze_files_solves_versus_reproducibly_with_a_seed(self):
+        solved = [list(analyze_files([_versus_path], solve=True,
+                                     processes=1, turns=1, beam_width=1,
+                                     seed=1))[0]
+                  for i in range(2)]
+        summaries = [result['summaries'] for result in solved]
+        self.assertTrue(summaries[0])
+        self.assertEqual(summaries[0], summaries[1])
+        for summary in summaries[0]:
+            self.assertIn('score_variance', summary)
+            self.assertIsNotNone(summary['score_interval'])
+
+    def test_analyze_files_solves_capture_in_a_process_pool(self):
+        results = list(analyze_files([_capture_path, _capture_path],
+                                     game_type='capture', solve=True,
+                                     processes=2))
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertTrue(result['board'].startswith('........'))
+            self.assertTrue(result['solution'])
+
+    def test_analyze_files_does_not_reuse_anything_from_earlier_files(self):
+        identifier = StateInvestigator._board_tools['tile_id']
+        with patch.object(identifier, 'identify_many',
+                          wraps=identifier.identify_many) as m_identify:
+            list(analyze_files([_versus_path, _versus_path], processes=1))
+        # every tile of both files is identified
+        self.assertEqual(m_identify.call_count, 2)
+        for args, kwargs in m_identify.call_args_list:
+            self.assertEqual(len(args[0]), 64)
+
+    def test_analyze_files_records_errors_and_continues(self):
+        missing_path = path.join(_here, 'missing.png')
+        results = list(analyze_files([missing_path, _versus_path],
+                                     processes=1))
+        self.assertIn('error', results[0])
+        self.assertNotIn('error', results[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
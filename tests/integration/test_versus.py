@@ -1,7 +1,9 @@
 import unittest
 
-from pqhelper.versus import Advisor
-from pqhelper.base import Board, Actor
+from pqhelper import versus
+from pqhelper.versus import Advisor, sequential_summaries
+from pqhelper.base import Board, Actor, State, Swap, Chance, EOT
+from pqhelper.base import Transposition
 
 
 class Test_Advisor(unittest.TestCase):
@@ -62,6 +64,161 @@ class Test_Advisor(unittest.TestCase):
         actions_remaming_spec = 1 + extra_actions
         self.assertEqual(advisor._root.actions_remaining, actions_remaming_spec)
 
+    def test_advance_reuses_the_subtree_of_a_matching_state(self):
+        advisor = Advisor()
+        advisor.reset(Board(self.board_string_3_valid_swaps),
+                      generic_actor('player'), generic_actor('opponent'), 1)
+        advisor._game.random_fill = False
+        advisor.simulate_next_turn()
+        advisor.simulate_next_turn()
+        # a state after the first of two actions in turn 1. its second
+        # actions all transpose to states reached by other first actions
+        match = root_action(advisor, ((7, 6), (7, 7))).children[0]
+        child_count = len(match.children)
+        reused = advisor.advance(match.board.copy(), match.player.copy(),
+                                 match.opponent.copy(), 0)
+        self.assertTrue(reused)
+        self.assertIsNone(advisor._root.parent)
+        self.assertEqual(len(advisor._root.children), child_count)
+        self.assertEqual(advisor.current_completed_turn, 2)
+
+    def test_advance_keeps_the_originals_of_transpositions(self):
+        advisor = Advisor()
+        advisor.reset(Board(self.board_string_3_valid_swaps),
+                      generic_actor('player'), generic_actor('opponent'), 1)
+        advisor._game.random_fill = False
+        advisor.simulate_next_turn()
+        advisor.simulate_next_turn()
+        match = root_action(advisor, ((7, 6), (7, 7))).children[0]
+        advisor.advance(match.board.copy(), match.player.copy(),
+                        match.opponent.copy(), 0)
+        kept = set(id(node) for node in advisor._root.post_order_nodes())
+        for node in advisor._root.post_order_nodes():
+            if isinstance(node, Transposition):
+                self.assertIn(id(node.state), kept)
+        summaries = advisor.sorted_current_summaries()
+        self.assertEqual(len(summaries), 2)
+        for summary in summaries:
+            self.assertGreater(summary.total_leaves, 0)
+        self.assertEqual(advisor.current_completed_turn, 2)
+
+    def test_summaries_count_the_leaves_of_transposed_originals(self):
+        advisor = Advisor()
+        advisor.reset(Board(self.board_string_3_valid_swaps),
+                      generic_actor('player'), generic_actor('opponent'), 1)
+        advisor._game.random_fill = False
+        advisor.simulate_next_turn()
+        advisor.simulate_next_turn()
+        summaries = dict((summary.action, summary)
+                         for summary in advisor.sorted_current_summaries())
+        # every second action of this root action is a transposition
+        transposed = summaries[((7, 6), (7, 7))]
+        self.assertEqual(transposed.total_leaves, 2)
+        self.assertEqual(transposed.mana_drain_leaves, 2)
+
+    def test_advance_resets_when_no_state_matches(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.simulate_next_turn()
+        other_actor = generic_actor('player', health=(10, 100))
+        reused = advisor.advance(Board(self.board_string_3_valid_swaps),
+                                 other_actor, generic_actor('opponent'), 0)
+        self.assertFalse(reused)
+        self.assertEqual(advisor.current_completed_turn, 0)
+        self.assertFalse(advisor._root.children)
+
+    def test_ponder_simulates_until_turns_are_completed(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.simulate_next_turn()
+        advisor.ponder(2)
+        self.assertEqual(advisor.current_completed_turn, 2)
+
+    def test_ponder_stops_when_told_not_to_keep_going(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.ponder(2, keep_going=lambda: False)
+        self.assertEqual(advisor.current_completed_turn, 0)
+
+    def test_ponder_stops_in_the_middle_of_a_turn(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.simulate_next_turn()
+        checks = list()
+        keep_going = lambda: checks.append(True) or len(checks) < 3
+        advisor.ponder(2, keep_going=keep_going)
+        self.assertEqual(len(checks), 3)
+        self.assertEqual(advisor.current_completed_turn, 1)
+
+    def test_simulate_next_turn_discards_an_interrupted_turn(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.simulate_next_turn()
+        leaves_spec = set(id(leaf) for leaf in advisor._root.leaves())
+        checks = list()
+        keep_going = lambda: checks.append(True) or len(checks) < 3
+        completed = advisor.simulate_next_turn(keep_going)
+        self.assertFalse(completed)
+        self.assertEqual(advisor.current_completed_turn, 1)
+        leaves = set(id(leaf) for leaf in advisor._root.leaves())
+        self.assertEqual(leaves, leaves_spec)
+        # the storage of the discarded states is reused
+        states = [node for node in advisor._root.post_order_nodes()
+                  if isinstance(node, State)]
+        self.assertEqual(len(advisor._root.arena), len(states))
+
+    def test_simulate_next_turn_returns_True_when_the_turn_completes(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        self.assertTrue(advisor.simulate_next_turn(lambda: True))
+        self.assertEqual(advisor.current_completed_turn, 1)
+
+    def test_simulate_next_turn_rewards_the_chosen_swaps_once(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.simulate_next_turn()
+        advisor.simulate_next_turn()  # the opponent chooses a reply
+        ordering = advisor._game.ordering
+        history = dict(ordering._history)
+        self.assertTrue(history)
+        self.assertTrue(ordering._killers)
+        # reading the scores does not change the search
+        advisor.sorted_current_summaries()
+        advisor.current_sim_scores()
+        advisor.top_is_separated()
+        self.assertEqual(ordering._history, history)
+
+    def test_advance_reuses_pondered_replies_to_the_player(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.ponder(3)
+        # the start of the player's next turn after the opponent's reply
+        match = [node for node in advisor._root.post_order_nodes()
+                 if isinstance(node, State) and node.turn == 3
+                 and node.actions_remaining == 1][0]
+        reused = advisor.advance(match.board, match.player,
+                                 match.opponent, 0)
+        self.assertTrue(reused)
+        self.assertEqual(advisor.current_completed_turn, 1)
+
+    def test_advance_extends_a_match_reached_by_only_some_sims(self):
+        advisor = Advisor(seed=1, sims=2, beam_width=1)
+        advisor.reset(Board(self.board_string_3_valid_swaps),
+                      generic_actor('player'), generic_actor('opponent'), 0)
+        advisor.ponder(3)
+        match = [node for node in advisor._root.post_order_nodes()
+                 if isinstance(node, State) and node.turn == 3
+                 and node.actions_remaining == 1 and node.sims == 2][0]
+        reused = advisor.advance(match.board, match.player,
+                                 match.opponent, 0)
+        self.assertTrue(reused)
+        # the first sim follows the second in the reused subtree
+        states = [node for node in advisor._root.post_order_nodes()
+                  if isinstance(node, State) and node is not advisor._root]
+        self.assertTrue(states)
+        for state in states:
+            self.assertEqual(state.sims, 0b11)
+        self.assertTrue(advisor.simulate_next_turn())
+        self.assertEqual(advisor.current_completed_turn, 2)
+        # chances below the root are weighted by all sims again
+        for node in advisor._root.post_order_nodes():
+            if isinstance(node, Swap):
+                chances = [c for c in node.children if isinstance(c, Chance)]
+                if chances:
+                    self.assertAlmostEqual(sum(c.weight for c in chances), 1)
+
     # Run the versus simulation one turn at a time
     def test_simulate_next_turn_produces_correct_tree_internally(self):
         advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
@@ -188,6 +345,216 @@ class Test_Advisor(unittest.TestCase):
                                  ''.format(ordered_swaps_turn_2_spec,
                                            ordered_swaps_turn_2))
 
+    def test_current_summaries_average_random_outcomes_by_weight(self):
+        advisor = Advisor()
+        player = generic_actor('player')
+        opponent = generic_actor('opponent', health=(50, 100))
+        advisor.reset(Board(), player, opponent, 0)
+        root = advisor._root
+        swap = Swap(((7, 0), (7, 1)))
+        root.graft_child(swap)
+        for weight, damage in ((0.25, 10), (0.75, 2)):
+            chance = Chance(weight)
+            swap.graft_child(chance)
+            result = State(Board(), player, opponent, 1, 0, arena=root.arena)
+            result.opponent.apply_attack(damage)
+            chance.graft_child(result)
+            result.graft_child(EOT(False))
+        summary, = advisor.sorted_current_summaries()
+        # health is worth double: 2 * (0.25 * 10 + 0.75 * 2)
+        self.assertAlmostEqual(summary.score, 8)
+
+    def test_action_scores_include_the_score_of_each_sim(self):
+        advisor = Advisor(sims=4)
+        player = generic_actor('player')
+        opponent = generic_actor('opponent', health=(50, 100))
+        advisor.reset(Board(), player, opponent, 0)
+        root = advisor._root
+        swap = Swap(((7, 0), (7, 1)))
+        root.graft_child(swap)
+        for sims, damage in ((0b0001, 10), (0b1110, 2)):
+            chance = Chance(bin(sims).count('1') / 4.0)
+            swap.graft_child(chance)
+            result = State(Board(), player, opponent, 1, 0, arena=root.arena,
+                           sims=sims)
+            result.opponent.apply_attack(damage)
+            chance.graft_child(result)
+            result.graft_child(EOT(False))
+        balances = advisor._leaf_balances(root)
+        score, sim_scores = advisor._action_scores(swap, balances)
+        self.assertAlmostEqual(score, 8)
+        self.assertEqual(list(sim_scores), [20, 4, 4, 4])
+
+    def test_drop_hopeless_only_continues_the_best_actions(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.simulate_next_turn()
+        best = advisor.sorted_current_summaries()[0].action
+        advisor.drop_hopeless(keep_fraction=0.3)
+        advisor.simulate_next_turn()
+        summaries = advisor.sorted_current_summaries()
+        self.assertEqual(summaries[0].action, best)
+        # only the kept action was simulated for the second turn
+        for swap in advisor._root.children:
+            depth = max(leaf.parent.turn for leaf in swap.leaves())
+            self.assertEqual(depth, 2 if swap.position_pair == best else 1)
+
+    def test_advance_to_the_same_root_keeps_the_contenders(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.simulate_next_turn()
+        advisor.drop_hopeless(keep_fraction=0.3)
+        advisor.simulate_next_turn()
+        best = advisor.sorted_current_summaries()[0].action
+        root = advisor._root
+        reused = advisor.advance(root.board, root.player, root.opponent, 0)
+        self.assertTrue(reused)
+        advisor.simulate_next_turn()
+        summaries = advisor.sorted_current_summaries()
+        self.assertEqual(summaries[0].action, best)
+        # only the kept action was simulated for the third turn
+        for swap in advisor._root.children:
+            depth = max(leaf.parent.turn for leaf in swap.leaves())
+            self.assertEqual(depth, 3 if swap.position_pair == best else 1)
+
+    def test_top_is_separated_never_when_the_sims_agree_exactly(self):
+        advisor = Advisor(sims=4)
+        advisor.reset(Board(self.board_string_3_valid_swaps),
+                      generic_actor('player'), generic_actor('opponent'), 0)
+        advisor._game.random_fill = False
+        advisor.simulate_next_turn()
+        scores = sorted(advisor.current_sim_scores().values(),
+                        key=sum, reverse=True)
+        self.assertGreater(sum(scores[0]), sum(scores[1]))
+        self.assertFalse(advisor.top_is_separated())
+
+    def test_top_is_ranked_needs_enough_sims_and_some_spread(self):
+        separated = [(10, [9, 11]), (0, [1, -1])]
+        self.assertTrue(versus._top_is_ranked(separated))
+        self.assertFalse(versus._top_is_ranked(separated, min_sims=3))
+        overlapping = [(10, [0, 20]), (0, [1, -1])]
+        self.assertFalse(versus._top_is_ranked(overlapping))
+        exact = [(10, [10, 10]), (0, [0, 0])]
+        self.assertFalse(versus._top_is_ranked(exact))
+        one_exact = [(10, [10, 10]), (0, [1, -1])]
+        self.assertTrue(versus._top_is_ranked(one_exact))
+
+    def test_current_summaries_have_a_confidence_interval_with_sims(self):
+        advisor = Advisor(seed=2, sims=3)
+        advisor.reset(Board(self.board_string_3_valid_swaps),
+                      generic_actor('player'), generic_actor('opponent'), 0)
+        advisor.simulate_next_turn()
+        for summary in advisor.sorted_current_summaries():
+            low, high = summary.score_interval
+            self.assertLessEqual(low, summary.score)
+            self.assertGreaterEqual(high, summary.score)
+            self.assertGreaterEqual(summary.score_variance, 0)
+
+    def test_current_summaries_have_no_interval_with_one_sim(self):
+        advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
+        advisor.simulate_next_turn()
+        for summary in advisor.sorted_current_summaries():
+            self.assertIsNone(summary.score_interval)
+
+    def test_sequential_summaries_stop_when_the_top_is_ranked(self):
+        # the skull match defeats the opponent so it is clearly the best
+        board_string = '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       'srssgbgg'
+        batches = list()
+        summaries = sequential_summaries(Board(board_string),
+                                         generic_actor('player'),
+                                         generic_actor('opponent',
+                                                       health=(3, 100)), 0,
+                                         turns=1, batch_sims=2, max_sims=8,
+                                         seed=1,
+                                         batch_summaries=batches.append)
+        self.assertIs(batches[-1], summaries)
+        self.assertEqual(len(batches), 1)
+        best, second = summaries[:2]
+        self.assertEqual(best.action, ((7, 0), (7, 1)))
+        self.assertGreater(best.score_interval[0], second.score_interval[1])
+
+    def test_sequential_summaries_run_max_sims_when_the_top_is_close(self):
+        batches = list()
+        summaries = sequential_summaries(Board(self.board_string_3_valid_swaps),
+                                         generic_actor('player'),
+                                         generic_actor('opponent'), 0,
+                                         turns=1, batch_sims=2, max_sims=8,
+                                         seed=1,
+                                         batch_summaries=batches.append)
+        self.assertEqual(len(summaries), 3)
+        self.assertIs(batches[-1], summaries)
+        self.assertEqual(len(batches), 4)
+
+    def test_current_summaries_score_defeating_the_opponent_decisively(self):
+        board_string = '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       'srssgbgg'
+        opponent = generic_actor('opponent', health=(3, 100))
+        advisor = generic_preset_advisor(board_string, opponent=opponent)
+        advisor.simulate_next_turn()
+        advisor.simulate_next_turn()
+        best = advisor.sorted_current_summaries()[0]
+        self.assertEqual(best.action, ((7, 0), (7, 1)))
+        self.assertGreater(best.score, 10000)
+
+    def test_transposed_actions_are_scored_the_same(self):
+        board_string = '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       '........\n' \
+                       'rrgrbbyb'
+        advisor = Advisor()
+        advisor.reset(Board(board_string),
+                      generic_actor('player'), generic_actor('opponent'), 1)
+        advisor._game.random_fill = False
+        advisor.simulate_next_turn()
+        first, second = advisor.sorted_current_summaries()
+        self.assertEqual(first.score, second.score)
+
+    def test_current_summaries_use_the_given_weights(self):
+        advisor = Advisor(weights={'c': 1})
+        advisor.reset(Board(self.board_string_3_valid_swaps),
+                      generic_actor('player'), generic_actor('opponent'), 0)
+        advisor._game.random_fill = False
+        advisor.simulate_next_turn()
+        # nothing on this board changes c
+        for summary in advisor.sorted_current_summaries():
+            self.assertEqual(summary.score, 0)
+
+    def test_simulations_to_average_share_one_tree(self):
+        advisor = Advisor(seed=2, sims=3)
+        advisor.reset(Board(self.board_string_3_valid_swaps),
+                      generic_actor('player'), generic_actor('opponent'), 0)
+        advisor.simulate_next_turn()
+        swaps = [summary.action for summary
+                 in advisor.sorted_current_summaries()]
+        self.assertEqual(len(swaps), 3)
+        # the root and each swap are stored once for all sims
+        root = advisor._root
+        states = [node for node in root.post_order_nodes()
+                  if isinstance(node, State)]
+        self.assertEqual(len(root.arena), len(states))
+        self.assertEqual(len(root.children), 3)
+        # each sim fills the swapped board in its own way
+        for swap in root.children:
+            chances = swap.children
+            self.assertGreater(len(chances), 1)
+            boards = [str(chance.children[0].board) for chance in chances]
+            self.assertEqual(len(set(boards)), len(boards))
+
     def test_current_summaries_generates_different_scoring_each_turn(self):
         advisor = generic_preset_advisor(self.board_string_3_valid_swaps)
         # sim and store scoring for turn 1
@@ -222,6 +589,12 @@ def generic_preset_advisor(board_string, player=None, opponent=None,
     return advisor
 
 
+def root_action(advisor, position_pair):
+    """Return the root swap of advisor with position_pair."""
+    return [swap for swap in advisor._root.children
+            if swap.position_pair == position_pair][0]
+
+
 def generic_actor(name=None, health=None,
                   r=None, g=None, b=None, y=None,
                   x=None, m=None, h=None, c=None):